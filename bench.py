@@ -0,0 +1,475 @@
+"""Load benchmark: runs the notifier against in-process Jellyfin and OneBot stand-ins.
+
+    python bench.py                                  # every scenario with its default size
+    python bench.py episodes --count 2000
+    python bench.py movies --forward-latency 0.05 --forward-error-rate 0.1 --json
+    python bench.py episodes --noise-frames 20       # a busy server's Sessions pushes in between
+    python bench.py policy --policies 300            # library_policies lookup only, no network
+
+Each scenario builds a synthetic library, replays it as LibraryChanged bursts over the
+websocket and reports throughput, p50/p99 notification latency (frame sent -> message
+accepted by the forward endpoint), Jellyfin/forward call counts, process CPU time and peak
+traced memory (the stand-ins run in the same process and are included in both; the
+synthetic library is not). The policy scenario instead times library_policies resolution
+in-process, PolicyMatcher against the linear scan it replaced.
+"""
+import argparse
+import asyncio
+import base64
+import hashlib
+import json
+import random
+import shutil
+import struct
+import sys
+import tempfile
+import time
+import tracemalloc
+import urllib.parse
+from typing import Any, Dict, List, Optional, Tuple
+
+import main
+
+WS_GUID = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+LIBRARIES = {"lib-anime": "新番", "lib-tv": "电视剧", "lib-movies": "电影"}
+
+# A resized poster is a few tens of KB; the content only has to round-trip.
+POSTER = b"\xff\xd8\xff\xe0" + bytes(40 * 1024)
+
+SCENARIOS = {
+    # name: (library, default item count, default series count)
+    "episodes": ("lib-anime", 10000, 50),
+    "season": ("lib-tv", 10000, 1),
+    "movies": ("lib-movies", 500, 0),
+}
+# In-process micro-benchmarks: name -> default lookup count.
+MICRO = {
+    "policy": 50000,
+}
+
+class FakeServer:
+    """Jellyfin (HTTP + /socket websocket) and a OneBot send_group_msg endpoint on one local port."""
+
+    def __init__(self, forward_latency: float = 0.0, forward_error_rate: float = 0.0):
+        self.forward_latency = forward_latency
+        self.forward_error_rate = forward_error_rate
+        self.items: Dict[str, Dict] = {}
+        self.children: Dict[str, List[Dict]] = {}
+        self.ancestors: Dict[str, List[Dict]] = {}
+        self.calls: Dict[str, int] = {}
+        self.frames: asyncio.Queue = asyncio.Queue()
+        self.sent_at: Dict[str, float] = {}
+        self.posts: List[Tuple[float, Dict]] = []
+        self.connected = asyncio.Event()
+        self._server: Optional[asyncio.AbstractServer] = None
+        self._writers: set = set()
+
+    async def start(self) -> int:
+        self._server = await asyncio.start_server(self._handle, "127.0.0.1", 0)
+        return self._server.sockets[0].getsockname()[1]
+
+    def close(self):
+        if self._server is not None:
+            self._server.close()
+        self.frames.put_nowait(None)
+        for writer in list(self._writers):
+            writer.close()
+
+    def add(self, item: Dict, ancestors: List[Dict]):
+        self.items[item["Id"]] = item
+        self.children.setdefault(item.get("ParentId") or "", []).append(item)
+        self.ancestors[item["Id"]] = ancestors
+
+    def _count(self, key: str):
+        self.calls[key] = self.calls.get(key, 0) + 1
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self._writers.add(writer)
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    return
+                method, target, _ = line.decode().split(" ", 2)
+                headers: Dict[str, str] = {}
+                while True:
+                    h = await reader.readline()
+                    if h in (b"\r\n", b"\n", b""):
+                        break
+                    k, v = h.decode().split(":", 1)
+                    headers[k.strip().lower()] = v.strip()
+                body = await reader.readexactly(int(headers["content-length"])) if "content-length" in headers else b""
+                url = urllib.parse.urlsplit(target)
+                if url.path == "/socket":
+                    await self._websocket(reader, writer, headers)
+                    return
+                status, obj = await self._route(method, url.path, dict(urllib.parse.parse_qsl(url.query)), body)
+                ctype = b"image/jpeg" if isinstance(obj, bytes) else b"application/json"
+                out = obj if isinstance(obj, bytes) else json.dumps(obj).encode()
+                writer.write(b"HTTP/1.1 %d X\r\nContent-Type: %s\r\nContent-Length: %d\r\n\r\n" % (status, ctype, len(out)) + out)
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            self._writers.discard(writer)
+            writer.close()
+
+    async def _route(self, method: str, path: str, q: Dict[str, str], body: bytes) -> Tuple[int, Any]:
+        if path == "/send_group_msg":
+            self._count("forward")
+            if self.forward_latency:
+                await asyncio.sleep(self.forward_latency)
+            if random.random() < self.forward_error_rate:
+                self._count("forward_errors")
+                return 500, {"status": "failed"}
+            # Only the subject is needed afterwards; keeping whole bodies would dwarf the notifier's memory.
+            self.posts.append((time.monotonic(), {"subject": json.loads(body).get("subject")}))
+            return 200, {"status": "ok"}
+        if path == "/Users/AuthenticateByName":
+            self._count("auth")
+            return 200, {"AccessToken": "bench"}
+        if path == "/Library/VirtualFolders":
+            self._count("virtual_folders")
+            return 200, [{"ItemId": k, "Name": v} for k, v in LIBRARIES.items()]
+        if path == "/Items" and "ids" in q:
+            self._count("items")
+            return 200, {"Items": [self.items[i] for i in q["ids"].split(",") if i in self.items]}
+        if path == "/Items":
+            self._count("items_paged")
+            found = self.children.get(q.get("ParentId") or "", [])
+            start = int(q.get("StartIndex", 0))
+            return 200, {"Items": found[start:start + int(q.get("Limit", len(found)))]}
+        if path.startswith("/Items/") and path.endswith("/Images/Primary"):
+            self._count("images")
+            return 200, POSTER
+        if path.startswith("/Items/") and path.endswith("/Ancestors"):
+            self._count("ancestors")
+            return 200, self.ancestors.get(path.split("/")[2], [])
+        return 404, {}
+
+    async def _websocket(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter, headers: Dict[str, str]):
+        accept = base64.b64encode(hashlib.sha1((headers["sec-websocket-key"] + WS_GUID).encode()).digest()).decode()
+        writer.write(("HTTP/1.1 101 Switching Protocols\r\nUpgrade: websocket\r\nConnection: Upgrade\r\n"
+                      f"Sec-WebSocket-Accept: {accept}\r\n\r\n").encode())
+        await writer.drain()
+        drain = asyncio.create_task(self._discard_client_frames(reader, writer))
+        self.connected.set()
+        try:
+            while True:
+                ids = await self.frames.get()
+                if ids is None:
+                    return
+                if isinstance(ids, bytes):
+                    data, ids = ids, []
+                else:
+                    data = json.dumps({"MessageType": "LibraryChanged", "Data": {"ItemsAdded": ids, "CollectionFolders": []}}).encode()
+                n = len(data)
+                if n < 126:
+                    header = bytes([0x81, n])
+                elif n < 65536:
+                    header = bytes([0x81, 126]) + struct.pack(">H", n)
+                else:
+                    header = bytes([0x81, 127]) + struct.pack(">Q", n)
+                writer.write(header + data)
+                await writer.drain()
+                now = time.monotonic()
+                for i in ids:
+                    self.sent_at[i] = now
+        finally:
+            drain.cancel()
+
+    async def _discard_client_frames(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while True:
+                head = await reader.readexactly(2)
+                n = head[1] & 127
+                if n == 126:
+                    n = struct.unpack(">H", await reader.readexactly(2))[0]
+                elif n == 127:
+                    n = struct.unpack(">Q", await reader.readexactly(8))[0]
+                await reader.readexactly(4 + n)
+                if head[0] & 0x0F == 0x8:
+                    # Answer the close handshake, or the client waits out its close timeout.
+                    writer.write(b"\x88\x00")
+                    writer.close()
+                    return
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+
+def sessions_frame(streams: int) -> bytes:
+    """A Sessions push as a busy server sends it: one entry with a now-playing item per active stream."""
+    sessions = [{
+        "Id": f"session{i:04d}", "UserName": f"user{i}", "Client": "Jellyfin Web", "DeviceName": "Chrome",
+        "NowPlayingItem": {"Id": f"{i:032x}", "Name": f"Episode {i}", "Type": "Episode", "SeriesName": f"Show {i}",
+                           "Overview": "A long synopsis of the episode. " * 20, "RunTimeTicks": 14_400_000_000},
+        "PlayState": {"PositionTicks": i * 10_000_000, "IsPaused": False, "PlayMethod": "DirectPlay"},
+    } for i in range(streams)]
+    return json.dumps({"MessageType": "Sessions", "MessageId": "bench", "Data": sessions}).encode()
+
+def build_library(fake: FakeServer, scenario: str, count: int, series: int) -> List[str]:
+    """Populate the fake server; returns the new item IDs in the order Jellyfin would announce them."""
+    lib_id = SCENARIOS[scenario][0]
+    lib = {"Id": lib_id, "Name": LIBRARIES[lib_id], "Type": "CollectionFolder"}
+    root = {"Id": "root", "Name": "root", "Type": "AggregateFolder"}
+    added: List[str] = []
+    if scenario == "movies":
+        for i in range(count):
+            movie = {"Id": f"movie{i:06d}", "Name": f"Movie {i}", "Type": "Movie", "ParentId": lib_id, "ImageTags": {"Primary": f"tag{i}"},
+                     "ProductionYear": 2024, "RunTimeTicks": 72_000_000_000, "Path": f"/media/movies/Movie {i}.mkv"}
+            fake.add(movie, [lib, root])
+            added.append(movie["Id"])
+        return added
+    series = max(1, series)
+    for s in range(series):
+        sid = f"series{s:04d}"
+        fake.add({"Id": sid, "Name": f"Show {s}", "Type": "Series", "ParentId": lib_id}, [lib, root])
+    per_series = [count // series + (1 if s < count % series else 0) for s in range(series)]
+    # Scans walk one series after another; interleave a little so shards see mixed bursts.
+    for e in range(max(per_series)):
+        for s in range(series):
+            if e >= per_series[s]:
+                continue
+            sid = f"series{s:04d}"
+            ep = {"Id": f"{sid}ep{e:05d}", "Name": f"Episode {e + 1}", "Type": "Episode", "SeriesId": sid, "SeriesPrimaryImageTag": f"tag{s}",
+                  "SeriesName": f"Show {s}", "ParentId": f"{sid}season1", "ParentIndexNumber": 1, "IndexNumber": e + 1,
+                  "RunTimeTicks": 14_400_000_000, "Path": f"/media/tv/Show {s}/S01E{e + 1:03d}.mkv"}
+            fake.add(ep, [{"Id": f"{sid}season1", "Name": "Season 1", "Type": "Season"}, {"Id": sid, "Name": f"Show {s}", "Type": "Series"}, lib, root])
+            added.append(ep["Id"])
+    return added
+
+def bench_config(port: int, args: argparse.Namespace, image_dir: str) -> Dict:
+    url = f"http://127.0.0.1:{port}"
+    return {
+        "server_url": url,
+        "username": "bench",
+        "password": "bench",
+        "forward_url": f"{url}/send_group_msg",
+        "group_id": 1,
+        "library_policies": [
+            {"libraries": ["新番"], "mode": "per_episode"},
+            {"libraries": ["电视剧"], "mode": "season_summary"},
+            {"libraries": ["电影"], "mode": "per_episode"},
+        ],
+        "dedupe": {"season_summary_delay_seconds": 1, "movie_delay_seconds": 1},
+        "ingest": {"workers": args.workers, "fetch_chunk_size": args.fetch_chunk_size},
+        "delivery": {"concurrency": args.delivery_concurrency, "rate_per_second": 0, "retries": 3, "backoff_seconds": 0.1, "queue_size": 1_000_000},
+        "state": {"path": ""},
+        "backfill": {"enabled": False},
+        "reload": {"enabled": False},
+        "images": {"enabled": args.images, "path": image_dir, "embed": args.image_embed},
+    }
+
+def expected_subjects(bot: "main.RealtimeItemAdded", fake: FakeServer, ids: List[str], scenario: str) -> Dict[str, List[str]]:
+    """Subject of every notification the scenario should produce, mapped to the items behind it."""
+    subjects: Dict[str, List[str]] = {}
+    for i in ids:
+        item = fake.items[i]
+        if scenario == "season":
+            subject = bot.build_season_payload(item["SeriesName"], 1, 2, item["SeriesId"])["subject"]
+        else:
+            subject = bot.build_payload(item)["subject"]
+        subjects.setdefault(subject, []).append(i)
+    return subjects
+
+def percentile(values: List[float], p: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(p * (len(ordered) - 1))))]
+
+async def run_scenario(scenario: str, args: argparse.Namespace) -> Dict[str, Any]:
+    count = args.count if args.count is not None else SCENARIOS[scenario][1]
+    series = args.series if args.series is not None else SCENARIOS[scenario][2]
+    fake = FakeServer(args.forward_latency, args.forward_error_rate)
+    port = await fake.start()
+    ids = build_library(fake, scenario, count, series)
+
+    if args.tracemalloc:
+        tracemalloc.start()
+        baseline = tracemalloc.get_traced_memory()[0]
+    image_dir = tempfile.mkdtemp(prefix="bench-images-")
+    hub = main.NotifyHub(bench_config(port, args, image_dir))
+    bot = main.RealtimeItemAdded(hub.cfg, hub)
+    subjects = expected_subjects(bot, fake, ids, scenario)
+    await asyncio.to_thread(bot.login)
+    task = asyncio.create_task(bot.run_ws())
+    await asyncio.wait_for(fake.connected.wait(), 30)
+
+    noise = sessions_frame(args.noise_streams) if args.noise_frames else b""
+    started = time.monotonic()
+    cpu_started = time.process_time()
+    for i in range(0, len(ids), args.frame_size):
+        for _ in range(args.noise_frames):
+            await fake.frames.put(noise)
+        await fake.frames.put(ids[i:i + args.frame_size])
+        if args.frame_interval:
+            await asyncio.sleep(args.frame_interval)
+
+    last_progress, seen = time.monotonic(), 0
+    while len(fake.posts) < len(subjects):
+        await asyncio.sleep(0.05)
+        if len(fake.posts) != seen:
+            last_progress, seen = time.monotonic(), len(fake.posts)
+        elif time.monotonic() - last_progress > args.idle_timeout:
+            break
+    finished = fake.posts[-1][0] if fake.posts else time.monotonic()
+    cpu = time.process_time() - cpu_started
+
+    peak = 0
+    if args.tracemalloc:
+        peak = tracemalloc.get_traced_memory()[1] - baseline
+        tracemalloc.stop()
+    task.cancel()
+    await asyncio.gather(task, return_exceptions=True)
+    fake.close()
+    await asyncio.sleep(0.1)
+    shutil.rmtree(image_dir, ignore_errors=True)
+
+    latencies = []
+    for posted_at, payload in fake.posts:
+        items = subjects.get(payload.get("subject") or "")
+        sent = [fake.sent_at[i] for i in items or [] if i in fake.sent_at]
+        if sent:
+            latencies.append(posted_at - max(sent))
+    wall = max(1e-9, finished - started)
+    return {
+        "scenario": scenario,
+        "items": len(ids),
+        "frames": (len(ids) + args.frame_size - 1) // args.frame_size,
+        "expected": len(subjects),
+        "delivered": len(fake.posts),
+        "wall_seconds": round(wall, 3),
+        "throughput_per_second": round(len(fake.posts) / wall, 1),
+        "items_per_second": round(len(ids) / wall, 1),
+        "latency_p50_ms": round(percentile(latencies, 0.50) * 1000, 1),
+        "latency_p99_ms": round(percentile(latencies, 0.99) * 1000, 1),
+        "cpu_seconds": round(cpu, 3),
+        "peak_memory_mb": round(peak / 1048576, 2) if args.tracemalloc else None,
+        "calls": dict(sorted(fake.calls.items())),
+    }
+
+def linear_policy(policies: Dict[str, Dict], by_norm: Dict[str, Dict], lib_id: str, lib_name: str) -> Optional[Dict]:
+    """library_policies resolution as it was before PolicyMatcher: a scan of the normalized table per lookup."""
+    p = policies.get(lib_id)
+    if p:
+        return p
+    p = policies.get(lib_name)
+    if p:
+        return p
+    norm = main.norm_name(lib_name)
+    p = by_norm.get(norm)
+    if p:
+        return p
+    if norm:
+        for k, v in by_norm.items():
+            if not k:
+                continue
+            if k in norm or norm in k:
+                return v
+    return None
+
+def run_policy(args: argparse.Namespace) -> Dict[str, Any]:
+    """Resolve a recurring set of ancestors against a large policy table, as the ingest path does per item."""
+    count = args.count if args.count is not None else MICRO["policy"]
+    # The {libraryNameOrId: policy} table _normalize_policies builds from library_policies.
+    policies: Dict[str, Dict] = {}
+    for i in range(args.policies):
+        policy = {"mode": random.choice(main.POLICY_MODES[:3])}
+        policies[f"库{i:04d}【合集】"] = policies[f"lib-{i:04d}"] = policy
+    # Most ancestors are seasons, series and folders that only the substring fallback can rule out.
+    ancestors = [(f"{i:032x}", f"Show {i} Season 1") for i in range(args.ancestors)]
+    for i in random.sample(range(args.policies), min(args.policies, max(1, args.ancestors // 10))):
+        ancestors[random.randrange(len(ancestors))] = (f"lib-{i:04d}", f"库{i:04d}（合集）")
+    lookups = [ancestors[i % len(ancestors)] for i in range(count)]
+
+    by_norm = {main.norm_name(k): v for k, v in policies.items() if isinstance(k, str)}
+    timings = {}
+    for name, resolve in (("linear", lambda a: linear_policy(policies, by_norm, *a)),
+                          ("matcher", lambda a, m=main.PolicyMatcher(policies): m.match(*a))):
+        cpu_started = time.process_time()
+        started = time.perf_counter()
+        results = [resolve(a) for a in lookups]
+        timings[name] = (time.perf_counter() - started, time.process_time() - cpu_started, results)
+    if timings["linear"][2] != timings["matcher"][2]:
+        raise AssertionError("PolicyMatcher and the linear scan disagree")
+    linear, matcher = timings["linear"][0], timings["matcher"][0]
+    return {
+        "scenario": "policy",
+        "policies": args.policies,
+        "ancestors": len(ancestors),
+        "lookups": count,
+        "hits": sum(1 for p in timings["matcher"][2] if p),
+        "linear_us_per_lookup": round(linear / count * 1e6, 3),
+        "matcher_us_per_lookup": round(matcher / count * 1e6, 3),
+        "speedup": round(linear / max(1e-9, matcher), 1),
+        "cpu_seconds": round(timings["linear"][1] + timings["matcher"][1], 3),
+    }
+
+def print_policy_report(r: Dict[str, Any]):
+    print(f"== policy: {r['lookups']} lookups of {r['ancestors']} ancestors against {r['policies']} policies ({r['hits']} hits)")
+    print(f"   linear {r['linear_us_per_lookup']} us/lookup  matcher {r['matcher_us_per_lookup']} us/lookup  "
+          f"speedup {r['speedup']}x  cpu {r['cpu_seconds']}s")
+
+def print_report(r: Dict[str, Any]):
+    mem = f"{r['peak_memory_mb']} MB" if r["peak_memory_mb"] is not None else "n/a"
+    print(f"== {r['scenario']}: {r['items']} items in {r['frames']} frames")
+    print(f"   delivered {r['delivered']}/{r['expected']} in {r['wall_seconds']}s "
+          f"({r['throughput_per_second']} msg/s, {r['items_per_second']} items/s)")
+    print(f"   latency p50 {r['latency_p50_ms']} ms  p99 {r['latency_p99_ms']} ms  peak memory {mem}  cpu {r['cpu_seconds']}s")
+    print("   calls " + " ".join(f"{k}={v}" for k, v in r["calls"].items()))
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    p = argparse.ArgumentParser(description="Benchmark the notifier against local Jellyfin/OneBot stand-ins.")
+    p.add_argument("scenarios", nargs="*", help=f"scenarios to run: {', '.join([*SCENARIOS, *MICRO])} (default: all)")
+    p.add_argument("--count", type=int, help="items (lookups for policy) per scenario (default depends on the scenario)")
+    p.add_argument("--series", type=int, help="series the episodes are spread over")
+    p.add_argument("--frame-size", type=int, default=100, help="item IDs per LibraryChanged frame")
+    p.add_argument("--frame-interval", type=float, default=0.0, help="seconds between frames")
+    p.add_argument("--noise-frames", type=int, default=0, help="Sessions frames sent before every LibraryChanged frame")
+    p.add_argument("--noise-streams", type=int, default=30, help="active streams described in each Sessions frame")
+    p.add_argument("--forward-latency", type=float, default=0.0, help="seconds the forward endpoint takes per message")
+    p.add_argument("--forward-error-rate", type=float, default=0.0, help="fraction of forward requests answered with 500")
+    p.add_argument("--workers", type=int, default=4)
+    p.add_argument("--fetch-chunk-size", type=int, default=100)
+    p.add_argument("--delivery-concurrency", type=int, default=4)
+    p.add_argument("--idle-timeout", type=float, default=15.0, help="give up after this long without a new delivery")
+    p.add_argument("--no-images", dest="images", action="store_false", help="reference posters by URL instead of caching them")
+    p.add_argument("--image-embed", choices=("base64", "file"), default="base64", help="how cached posters are put into the message")
+    p.add_argument("--policies", type=int, default=300, help="library_policies entries in the policy scenario")
+    p.add_argument("--ancestors", type=int, default=50, help="distinct ancestors the policy scenario resolves")
+    p.add_argument("--seed", type=int, default=1)
+    p.add_argument("--no-tracemalloc", dest="tracemalloc", action="store_false", help="skip memory tracing (it slows the run)")
+    p.add_argument("--json", action="store_true", help="print one JSON object per scenario")
+    p.add_argument("--verbose", action="store_true", help="show the notifier's info log on stderr (errors are always shown)")
+    args = p.parse_args(argv)
+    unknown = [s for s in args.scenarios if s not in SCENARIOS and s not in MICRO]
+    if unknown:
+        p.error(f"unknown scenario: {', '.join(unknown)}")
+    args.scenarios = args.scenarios or [*SCENARIOS, *MICRO]
+    args.frame_size = max(1, args.frame_size)
+    args.policies = max(1, args.policies)
+    args.ancestors = max(1, args.ancestors)
+    return args
+
+def main_bench(argv: Optional[List[str]] = None):
+    args = parse_args(argv)
+    listener = main.setup_logging({"logging": {"level": "INFO" if args.verbose else "ERROR"}}, sys.stderr)
+    try:
+        for scenario in args.scenarios:
+            random.seed(args.seed)
+            if scenario == "policy":
+                result = run_policy(args)
+            else:
+                result = asyncio.run(run_scenario(scenario, args))
+            if args.json:
+                print(json.dumps(result, ensure_ascii=False))
+            elif scenario == "policy":
+                print_policy_report(result)
+            else:
+                print_report(result)
+            sys.stdout.flush()
+    finally:
+        listener.stop()
+
+if __name__ == "__main__":
+    main_bench()
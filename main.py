@@ -1,8 +1,26 @@
+import argparse
 import asyncio
+import base64
+import bisect
+import functools
+import gzip
+import hashlib
+import heapq
 import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import re
+import signal
+import sqlite3
+import sys
 import time
-from collections import defaultdict
-from typing import Any, Dict, List, Optional, Tuple
+import urllib.parse
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, AsyncIterator, Awaitable, Callable, Deque, Dict, Iterator, List, NamedTuple, Optional, Set, TextIO, Tuple, Union
 
 import requests
 import websockets
@@ -10,82 +28,1866 @@ import yaml
 from requests.adapters import HTTPAdapter
 from urllib3.util.retry import Retry
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 CONFIG_FILE = "config.yaml"
+INDEX_PAGE_SIZE = 1000
+ITEM_FIELDS = (
+    "SeriesId",
+    "SeriesName",
+    "SeasonId",
+    "ParentId",
+    "ParentIndexNumber",
+    "IndexNumber",
+    "ProductionYear",
+    "RunTimeTicks",
+    "Overview",
+    "Path",
+    "Album",
+    "AlbumArtist",
+    "Artists",
+    "MediaType",
+    "DateCreated",
+)
+# Fields every notification needs, and the extra ones album payloads and keyword filters read.
+BASE_FIELDS = frozenset({
+    "SeriesId",
+    "SeriesName",
+    "ParentId",
+    "ParentIndexNumber",
+    "IndexNumber",
+    "ProductionYear",
+    "RunTimeTicks",
+    "DateCreated",
+})
+ALBUM_FIELDS = frozenset({"Album", "AlbumArtist", "Artists"})
+POLICY_MODES = ("per_episode", "season_summary", "album_only", "mute")
+FILTER_FIELDS = frozenset({"Overview", "Path", "Album", "AlbumArtist", "Artists"})
 
 def load_config() -> Dict:
     with open(CONFIG_FILE, "r", encoding="utf-8") as f:
         return yaml.safe_load(f)
 
-class RealtimeItemAdded:
+LOG = logging.getLogger("jellyfin_notify")
+LOG_FIELDS = ("server", "item", "subject", "target", "stage", "duration_ms", "status", "count", "error")
+
+class TextFormatter(logging.Formatter):
+    """The familiar `[time]【...】...` console lines."""
 
     def __init__(self):
-        self.cfg = load_config()
-        self.server = self.cfg["server_url"].rstrip("/")
-        self.forward_url = self.cfg.get("forward_url")
-        self.group_id = self.cfg.get("group_id")
+        super().__init__("[%(asctime)s]%(message)s", "%Y-%m-%d %H:%M:%S")
+
+    def format(self, record: logging.LogRecord) -> str:
+        line = super().format(record)
+        suppressed = getattr(record, "suppressed", 0)
+        return f"{line}（此前另有 {suppressed} 条相同日志已省略）" if suppressed else line
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line: time, level, message and whichever structured fields were given."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        out = {
+            "ts": time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(record.created)) + f".{int(record.msecs):03d}",
+            "level": record.levelname,
+            "msg": record.getMessage(),
+        }
+        for key in LOG_FIELDS + ("suppressed",):
+            value = record.__dict__.get(key)
+            if value is not None:
+                out[key] = value
+        return json.dumps(out, ensure_ascii=False, default=str)
+
+class RateLimitFilter(logging.Filter):
+    """At most `burst` WARNING+ records per message template per window; the next one that passes reports how many were held back."""
+
+    def __init__(self, window: float, burst: int):
+        super().__init__()
+        self.window = window
+        self.burst = burst
+        self._slots: Dict[str, List[float]] = {}
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno < logging.WARNING or self.burst <= 0:
+            return True
+        key = record.msg if isinstance(record.msg, str) else repr(record.msg)
+        slot = self._slots.get(key)
+        if slot is None or record.created - slot[0] >= self.window:
+            if slot is not None and slot[2]:
+                record.suppressed = int(slot[2])
+            self._slots[key] = [record.created, 1, 0]
+            return True
+        slot[1] += 1
+        if slot[1] <= self.burst:
+            return True
+        slot[2] += 1
+        return False
+
+class BoundedQueueHandler(logging.handlers.QueueHandler):
+    """Never blocks the caller: if the writer thread falls behind, records are dropped and counted."""
+
+    def __init__(self, q: "queue.Queue[logging.LogRecord]"):
+        super().__init__(q)
+        self._m_dropped = METRICS.counter("notify_log_dropped_total", "Log records dropped because the writer thread fell behind")
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # The listener lives in this process, so the record goes over as is and is formatted on the writer thread.
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self._m_dropped.inc()
+
+def log_level(cfg: Dict) -> int:
+    level = logging.getLevelName(str((cfg.get("logging") or {}).get("level") or "INFO").upper())
+    return level if isinstance(level, int) else logging.INFO
+
+def setup_logging(cfg: Dict, stream: Optional[TextIO] = None) -> logging.handlers.QueueListener:
+    """Route LOG through a bounded queue to a writer thread; returns the listener to stop on exit."""
+    log_cfg = (cfg.get("logging") or {})
+    try:
+        queue_size = max(1, int(log_cfg.get("queue_size", 10000)))
+    except Exception:
+        queue_size = 10000
+    try:
+        window = max(1.0, float(log_cfg.get("rate_limit_window_seconds", 60)))
+    except Exception:
+        window = 60.0
+    try:
+        burst = max(0, int(log_cfg.get("rate_limit_burst", 5)))
+    except Exception:
+        burst = 5
+    path = log_cfg.get("file")
+    handler = logging.FileHandler(str(path), encoding="utf-8") if path else logging.StreamHandler(stream or sys.stdout)
+    handler.setFormatter(JsonFormatter() if str(log_cfg.get("format") or "text").lower() == "json" else TextFormatter())
+    q: "queue.Queue[logging.LogRecord]" = queue.Queue(maxsize=queue_size)
+    queue_handler = BoundedQueueHandler(q)
+    queue_handler.addFilter(RateLimitFilter(window, burst))
+    LOG.handlers[:] = [queue_handler]
+    LOG.setLevel(log_level(cfg))
+    LOG.propagate = False
+    listener = logging.handlers.QueueListener(q, handler, respect_handler_level=True)
+    listener.start()
+    return listener
+
+_NAME_TABLE = str.maketrans({
+    "（": "(",
+    "）": ")",
+    "【": "[",
+    "】": "]",
+    "｛": "{",
+    "｝": "}",
+})
+
+def norm_name(s: Optional[str]) -> str:
+    if not s:
+        return ""
+    out = s.translate(_NAME_TABLE)
+    out = out.replace("\u3000", " ").strip().lower()
+    return out
+
+# Frames we act on are rare next to Sessions/UserDataChanged/progress traffic; triage on the raw text first.
+_FRAME_TYPE = re.compile(r'"(?:MessageType|message_type)"\s*:\s*"([^"]*)"')
+_FRAME_TYPE_BYTES = re.compile(rb'"(?:MessageType|message_type)"\s*:\s*"([^"]*)"')
+json_loads = orjson.loads if orjson is not None else json.loads
+
+def frame_is_library_changed(raw: Union[str, bytes]) -> bool:
+    """Cheap check before decoding; False only for frames that are certainly not LibraryChanged."""
+    if isinstance(raw, str):
+        pattern, needle = _FRAME_TYPE, "LibraryChanged"
+    else:
+        pattern, needle = _FRAME_TYPE_BYTES, b"LibraryChanged"
+    # Jellyfin serializes MessageType first; other layouts fall back to scanning the frame.
+    m = pattern.search(raw, 0, 64)
+    if m is None:
+        if needle not in raw:
+            return False
+        m = pattern.search(raw)
+    return m is None or m.group(1) == needle
+
+_CQ_TABLE = str.maketrans({"&": "&amp;", "[": "&#91;", "]": "&#93;", ",": "&#44;"})
 
-        fcfg = self.cfg.get("filters", {}) or {}
+def cq_escape(s: str) -> str:
+    """Escape a CQ code parameter value (URLs carry & and , in their query strings)."""
+    return s.translate(_CQ_TABLE)
+
+# Bookkeeping carried with a payload that is not part of the OneBot request.
+_LOCAL_KEYS = ("poster", "outbox")
+
+def request_body(payload: Dict) -> Dict:
+    """The JSON posted for a payload, with its cached poster embedded as base64 or checked (blocking I/O).
+
+    A poster evicted since the payload was built falls back to the resized Jellyfin URL.
+    """
+    body = {k: v for k, v in payload.items() if k not in _LOCAL_KEYS}
+    poster = payload.get("poster")
+    if poster:
+        if poster.get("embed") == "file":
+            image = poster["ref"] if os.path.exists(poster["path"]) else poster["url"]
+        else:
+            try:
+                with open(poster["path"], "rb") as f:
+                    image = "base64://" + base64.b64encode(f.read()).decode("ascii")
+            except OSError:
+                image = poster["url"]
+        body["message"] = body["message"].replace(poster["ref"], image, 1)
+    return body
+
+def _trie_pattern(words: List[str]) -> str:
+    trie: Dict[str, Dict] = {}
+    for w in words:
+        node = trie
+        for ch in w:
+            node = node.setdefault(ch, {})
+        node[""] = {}
+
+    # Built bottom-up with an explicit stack: one level per character would overflow the
+    # recursion limit on a long keyword. Only presence matters, so a keyword that ends at a
+    # node makes the longer ones below it redundant.
+    built: Dict[int, str] = {}
+    stack: List[Tuple[Dict[str, Dict], bool]] = [(trie, False)]
+    while stack:
+        node, expanded = stack.pop()
+        if "" in node:
+            built[id(node)] = ""
+        elif not expanded:
+            stack.append((node, True))
+            stack.extend((child, False) for child in node.values())
+        else:
+            alts = [re.escape(ch) + built[id(child)] for ch, child in sorted(node.items())]
+            built[id(node)] = alts[0] if len(alts) == 1 else "(?:" + "|".join(alts) + ")"
+    return built[id(trie)]
+
+class KeywordMatcher:
+    """Filter keywords compiled into one trie-shaped regex, so a check is a single scan of the text."""
+
+    def __init__(self, keywords: List[str]):
+        words = [str(k).lower() for k in keywords]
+        self.empty = not words
+        # An empty keyword is contained in every text.
+        self.match_all = "" in words
+        words = [w for w in dict.fromkeys(words) if w]
+        self._pattern = re.compile(_trie_pattern(words)) if words else None
+
+    def search(self, hay_lower: str) -> bool:
+        if self.match_all:
+            return True
+        return self._pattern is not None and self._pattern.search(hay_lower) is not None
+
+class KeywordFilter:
+    """The whitelist/blacklist pair of a `filters` config section."""
+
+    def __init__(self, fcfg: Optional[Dict]):
+        fcfg = fcfg or {}
         wl = fcfg.get("whitelist", {}) or {}
         bl = fcfg.get("blacklist", {}) or {}
         self.whitelist_enabled = bool(wl.get("enabled", False))
-        self.whitelist = [str(x).lower() for x in (wl.get("keywords") or [])]
         self.blacklist_enabled = bool(bl.get("enabled", False))
-        self.blacklist = [str(x).lower() for x in (bl.get("keywords") or [])]
+        self.whitelist = KeywordMatcher(wl.get("keywords") or [])
+        self.blacklist = KeywordMatcher(bl.get("keywords") or [])
 
-        self.library_policies = self._normalize_policies(self.cfg.get("library_policies", []))
-        self.library_policies_norm: Dict[str, Dict] = {}
-        for k, v in self.library_policies.items():
+    @property
+    def active(self) -> bool:
+        return self.whitelist_enabled or self.blacklist_enabled
+
+    def passes(self, hay_lower: str) -> bool:
+        if self.blacklist_enabled and not self.blacklist.empty:
+            if self.blacklist.search(hay_lower):
+                return False
+        if self.whitelist_enabled:
+            if self.whitelist.empty or not self.whitelist.search(hay_lower):
+                return False
+        return True
+
+class PolicyMatcher:
+    """library_policies compiled into lookup tables; results are memoized per (id, name)."""
+
+    MEMO_LIMIT = 10000
+
+    def __init__(self, policies: Dict[str, Dict]):
+        self.by_key: Dict[str, Dict] = dict(policies)
+        self.by_norm: Dict[str, Dict] = {}
+        for k, v in policies.items():
             if isinstance(k, str):
-                self.library_policies_norm[self._norm_name(k)] = v
-        self.client = "Yukari Notify Bot"
-        self.device = "Yukari Notify Bot"
-        self.version = "1.0.0"
+                self.by_norm[norm_name(k)] = v
+        self._fuzzy: List[Tuple[str, Dict]] = [(k, v) for k, v in self.by_norm.items() if k]
+        self._memo: Dict[Tuple[str, str], Optional[Dict]] = {}
+
+    def match(self, lib_id: str, lib_name: str) -> Optional[Dict]:
+        key = (lib_id, lib_name)
+        try:
+            return self._memo[key]
+        except KeyError:
+            pass
+        p = self._match(lib_id, lib_name)
+        if len(self._memo) >= self.MEMO_LIMIT:
+            self._memo.clear()
+        self._memo[key] = p
+        return p
+
+    def _match(self, lib_id: str, lib_name: str) -> Optional[Dict]:
+        """Prefer library ID, then name, then normalized name, then substring containment."""
+        p = self.by_key.get(lib_id)
+        if p:
+            return p
+        p = self.by_key.get(lib_name)
+        if p:
+            return p
+        norm = norm_name(lib_name)
+        p = self.by_norm.get(norm)
+        if p:
+            return p
+        if norm:
+            for k, v in self._fuzzy:
+                if k in norm or norm in k:
+                    return v
+        return None
+
+class ItemRecord:
+    """The few fields of a Jellyfin item that pending batches and the payload builders read."""
+
+    __slots__ = (
+        "Id",
+        "Type",
+        "Name",
+        "SeriesId",
+        "SeriesName",
+        "ParentIndexNumber",
+        "IndexNumber",
+        "ProductionYear",
+        "RunTimeTicks",
+        "Album",
+        "AlbumArtist",
+        "Artists",
+    )
+    _SHARED = ("Type", "SeriesId", "SeriesName", "AlbumArtist")
+
+    def __init__(self, item: Dict):
+        for k in self.__slots__:
+            v = item.get(k)
+            if isinstance(v, list):
+                v = tuple(v)
+            elif k in self._SHARED and isinstance(v, str):
+                v = sys.intern(v)
+            setattr(self, k, v)
+
+    @classmethod
+    def of(cls, item: Any) -> "ItemRecord":
+        return item if isinstance(item, cls) else cls(item)
+
+    def get(self, key: str, default: Any = None) -> Any:
+        v = getattr(self, key, None)
+        return default if v is None else v
+
+    def to_dict(self) -> Dict:
+        out = {}
+        for k in self.__slots__:
+            v = getattr(self, k)
+            if v is not None:
+                out[k] = list(v) if isinstance(v, tuple) else v
+        return out
+
+def _json_default(o: Any) -> Any:
+    if isinstance(o, ItemRecord):
+        return o.to_dict()
+    raise TypeError(f"{type(o).__name__} is not JSON serializable")
+
+class Clock:
+    """Time source for due times, expiry and windows; replay swaps in a VirtualClock."""
+
+    def time(self) -> float:
+        return time.time()
+
+    def monotonic(self) -> float:
+        return time.monotonic()
+
+class VirtualClock(Clock):
+    """Follows the loop's (virtual) time, anchored at a recorded wall-clock instant."""
+
+    def __init__(self, loop: asyncio.AbstractEventLoop, start: float):
+        self._loop = loop
+        self._offset = start - loop.time()
+
+    def time(self) -> float:
+        return self._loop.time() + self._offset
+
+    def monotonic(self) -> float:
+        return self._loop.time()
+
+CLOCK: Clock = Clock()
+
+class ExpiringSet:
+    """Keys that expire after a fixed TTL.
+
+    Entries are kept in insertion order, which is also expiry order, so expired keys are
+    dropped from the front a few at a time instead of by sweeping the whole set. Explicit
+    expiries are capped at now + TTL and shortening the TTL caps the live entries too, so
+    that order holds as long as callers add restored keys sorted by expiry.
+    """
+
+    def __init__(self, ttl_seconds: float, max_entries: int = 0):
+        self.ttl_seconds = max(1.0, float(ttl_seconds))
+        self.max_entries = max(0, int(max_entries))
+        self._items: "OrderedDict[str, float]" = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    def _expire(self, now: float):
+        items = self._items
+        while items:
+            key = next(iter(items))
+            if items[key] > now:
+                break
+            items.popitem(last=False)
+
+    def __contains__(self, key: str) -> bool:
+        now = CLOCK.time()
+        self._expire(now)
+        exp = self._items.get(key)
+        return exp is not None and exp > now
+
+    def set_ttl(self, ttl_seconds: float):
+        ttl = max(1.0, float(ttl_seconds))
+        if ttl < self.ttl_seconds:
+            cap = CLOCK.time() + ttl
+            for key, exp in self._items.items():
+                if exp > cap:
+                    self._items[key] = cap
+        self.ttl_seconds = ttl
+
+    def add(self, key: str, expires: Optional[float] = None):
+        self._items.pop(key, None)
+        limit = CLOCK.time() + self.ttl_seconds
+        self._items[key] = limit if expires is None else min(expires, limit)
+        if self.max_entries and len(self._items) > self.max_entries:
+            self._items.popitem(last=False)
+
+    def expires_at(self, key: str) -> Optional[float]:
+        return self._items.get(key)
+
+    def check_and_add(self, key: str) -> bool:
+        """Return True if the key is still live; otherwise record it and return False."""
+        if key in self:
+            return True
+        self.add(key)
+        return False
+
+class Counter:
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = 0.0
+
+    def inc(self, amount: float = 1):
+        self.value += amount
+
+class Histogram:
+    __slots__ = ("buckets", "counts", "sum", "count")
+
+    def __init__(self, buckets: Tuple[float, ...]):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+class Metrics:
+    """Counters and histograms rendered in the Prometheus text format.
+
+    Callers look up a labelled child once and keep it, so the hot path is a float add
+    (or a bisect for histograms). Gauges are read from collectors at scrape time.
+    """
+
+    LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300, 900)
+    SIZE_BUCKETS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000)
+
+    def __init__(self):
+        self._families: Dict[str, Tuple[str, str, Dict[Tuple[Tuple[str, str], ...], Any]]] = {}
+        self._collectors: Dict[str, Callable[[], List[Tuple[str, str, str, Dict[str, str], float]]]] = {}
+
+    def _child(self, kind: str, name: str, help_text: str, labels: Dict[str, Any], make: Callable[[], Any]):
+        family = self._families.setdefault(name, (kind, help_text, {}))
+        key = tuple(sorted((k, str(v)) for k, v in labels.items()))
+        child = family[2].get(key)
+        if child is None:
+            child = family[2][key] = make()
+        return child
+
+    def counter(self, name: str, help_text: str, **labels) -> Counter:
+        return self._child("counter", name, help_text, labels, Counter)
+
+    def histogram(self, name: str, help_text: str, buckets: Tuple[float, ...] = LATENCY_BUCKETS, **labels) -> Histogram:
+        return self._child("histogram", name, help_text, labels, lambda: Histogram(buckets))
+
+    def set_collector(self, key: str, fn: Callable[[], List[Tuple[str, str, str, Dict[str, str], float]]]):
+        """fn returns (name, type, help, labels, value) samples when scraped; a later fn replaces one with the same key."""
+        self._collectors[key] = fn
+
+    @staticmethod
+    def _labels(pairs) -> str:
+        if not pairs:
+            return ""
+        inner = ",".join('%s="%s"' % (k, str(v).replace("\\", "\\\\").replace('"', '\\"')) for k, v in pairs)
+        return "{" + inner + "}"
+
+    def render(self) -> str:
+        lines: List[str] = []
+        for name, (kind, help_text, children) in sorted(self._families.items()):
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            for key, child in children.items():
+                if kind == "counter":
+                    lines.append(f"{name}{self._labels(key)} {child.value}")
+                    continue
+                cumulative = 0
+                for bound, n in zip(child.buckets + (float("inf"),), child.counts):
+                    cumulative += n
+                    le = "+Inf" if bound == float("inf") else repr(float(bound))
+                    lines.append(f"{name}_bucket{self._labels(key + (('le', le),))} {cumulative}")
+                lines.append(f"{name}_sum{self._labels(key)} {child.sum}")
+                lines.append(f"{name}_count{self._labels(key)} {child.count}")
+        # Samples of one metric from several collectors must still be grouped under a single header.
+        families: Dict[str, List[str]] = {}
+        for collect in list(self._collectors.values()):
+            try:
+                samples = collect()
+            except Exception:
+                continue
+            for name, kind, help_text, labels, value in samples:
+                if name not in families:
+                    families[name] = [f"# HELP {name} {help_text}", f"# TYPE {name} {kind}"]
+                families[name].append(f"{name}{self._labels(sorted(labels.items()))} {float(value)}")
+        for family in families.values():
+            lines.extend(family)
+        return "\n".join(lines) + "\n"
+
+    async def serve(self, host: str, port: int) -> asyncio.AbstractServer:
+        """Minimal HTTP endpoint: GET /metrics returns the text exposition, anything else 404."""
+
+        async def handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+            try:
+                request = await reader.readline()
+                while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+                    pass
+                parts = request.split()
+                path = parts[1].split(b"?")[0] if len(parts) > 1 else b""
+                if path == b"/metrics":
+                    status, ctype, body = "200 OK", "text/plain; version=0.0.4; charset=utf-8", self.render().encode()
+                else:
+                    status, ctype, body = "404 Not Found", "text/plain; charset=utf-8", b"not found\n"
+                writer.write(f"HTTP/1.1 {status}\r\nContent-Type: {ctype}\r\nContent-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body)
+                await writer.drain()
+            except (ConnectionError, asyncio.IncompleteReadError):
+                pass
+            finally:
+                writer.close()
+
+        return await asyncio.start_server(handle, host, port)
+
+METRICS = Metrics()
+
+class AncestryEntry(NamedTuple):
+    expires: float
+    ancestors: List[Dict]
+    library: Tuple[str, str]
+
+class AncestryCache:
+    """Bounded LRU/TTL cache of /Items/{id}/Ancestors, merging concurrent loads of the same key."""
+
+    def __init__(self, max_entries: int = 5000, ttl_seconds: float = 3600):
+        self.max_entries = max(1, int(max_entries))
+        self.ttl_seconds = max(1.0, float(ttl_seconds))
+        self._entries: "OrderedDict[str, AncestryEntry]" = OrderedDict()
+        self._inflight: Dict[str, asyncio.Future] = {}
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def peek(self, key: str) -> Optional[AncestryEntry]:
+        entry = self._entries.get(key)
+        if entry is not None and entry.expires <= CLOCK.time():
+            self._entries.pop(key, None)
+            entry = None
+        if entry is None:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry
+
+    def put(self, key: str, ancestors: List[Dict]) -> AncestryEntry:
+        lib = ("", "")
+        for a in ancestors:
+            if a.get("Type") == "CollectionFolder":
+                lib = (a.get("Id") or "", a.get("Name") or "")
+                break
+        entry = AncestryEntry(CLOCK.time() + self.ttl_seconds, ancestors, lib)
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+        return entry
+
+    async def get_or_load(self, key: str, loader: Callable[[], Awaitable[Optional[List[Dict]]]]) -> Optional[AncestryEntry]:
+        """Return the cached entry or load it; concurrent callers for one key share a single request."""
+        entry = self.peek(key)
+        if entry is not None:
+            return entry
+        fut = self._inflight.get(key)
+        if fut is not None:
+            return await asyncio.shield(fut)
+        fut = asyncio.get_running_loop().create_future()
+        self._inflight[key] = fut
+        try:
+            ancestors = await loader()
+            entry = self.put(key, ancestors) if ancestors is not None else None
+            fut.set_result(entry)
+            return entry
+        except BaseException:
+            fut.set_result(None)
+            raise
+        finally:
+            self._inflight.pop(key, None)
+
+class ImageEntry(NamedTuple):
+    tag: str
+    path: str
+    size: int
+
+class ImageCache:
+    """Bounded on-disk LRU of resized posters, keyed by item and image tag.
+
+    Files are named {sha1(key)}-{tag}.jpg, so the index is rebuilt from the directory on
+    startup and a poster replaced in Jellyfin (new tag) is fetched again.
+    """
+
+    def __init__(self, directory: str, max_entries: int = 2000, max_bytes: int = 200 * 1048576):
+        self.directory = directory
+        self.max_entries = max(1, int(max_entries))
+        self.max_bytes = max(1, int(max_bytes))
+        self._entries: "OrderedDict[str, ImageEntry]" = OrderedDict()
+        self._inflight: Dict[Tuple[str, str], asyncio.Future] = {}
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(directory, exist_ok=True)
+        found = []
+        for name in os.listdir(directory):
+            path = os.path.join(directory, name)
+            if name.endswith(".tmp"):
+                os.remove(path)
+                continue
+            digest, sep, rest = name.partition("-")
+            if not sep or not rest.endswith(".jpg"):
+                continue
+            st = os.stat(path)
+            found.append((st.st_mtime, digest, ImageEntry(rest[:-4], path, st.st_size)))
+        for _, digest, entry in sorted(found):
+            self._store(digest, entry)
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    @staticmethod
+    def _digest(key: str) -> str:
+        return hashlib.sha1(key.encode("utf-8")).hexdigest()
+
+    def path_for(self, key: str, tag: str) -> str:
+        safe_tag = re.sub(r"[^0-9A-Za-z]", "", tag or "")
+        return os.path.join(self.directory, f"{self._digest(key)}-{safe_tag}.jpg")
+
+    def lookup(self, key: str) -> Optional[str]:
+        """Path of the cached poster for key, whatever its tag."""
+        entry = self._entries.get(self._digest(key))
+        return entry.path if entry is not None else None
+
+    def _store(self, digest: str, entry: ImageEntry):
+        old = self._entries.pop(digest, None)
+        if old is not None:
+            self.bytes -= old.size
+            if old.path != entry.path:
+                self._remove(old.path)
+        self._entries[digest] = entry
+        self.bytes += entry.size
+        while len(self._entries) > 1 and (len(self._entries) > self.max_entries or self.bytes > self.max_bytes):
+            _, evicted = self._entries.popitem(last=False)
+            self.bytes -= evicted.size
+            self._remove(evicted.path)
+
+    @staticmethod
+    def _remove(path: str):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    async def get_or_load(self, key: str, tag: str, loader: Callable[[str], Awaitable[Optional[int]]]) -> Optional[str]:
+        """Return the cached path or have loader write it (returning the size); one load per key and tag."""
+        digest = self._digest(key)
+        entry = self._entries.get(digest)
+        if entry is not None and entry.path == self.path_for(key, tag):
+            self._entries.move_to_end(digest)
+            self.hits += 1
+            return entry.path
+        fut = self._inflight.get((key, tag))
+        if fut is not None:
+            return await asyncio.shield(fut)
+        self.misses += 1
+        fut = asyncio.get_running_loop().create_future()
+        self._inflight[(key, tag)] = fut
+        path = None
+        try:
+            dest = self.path_for(key, tag)
+            size = await loader(dest)
+            if size is not None:
+                self._store(digest, ImageEntry(tag, dest, size))
+                path = dest
+            return path
+        finally:
+            fut.set_result(path)
+            self._inflight.pop((key, tag), None)
+
+class StateStore:
+    """Pending batches and suppression state in SQLite (WAL), written through in batches.
+
+    Callers record changes with put/delete; a background task writes everything dirty in one
+    transaction per interval, so the event path never waits on disk.
+    """
+
+    TABLES = ("season_batches", "movie_queue", "episode_sent", "meta", "outbox")
+    # Tables whose value is an expiry timestamp; expired rows are deleted along with a write.
+    EXPIRING_TABLES = ("episode_sent",)
+    PRUNE_INTERVAL = 300.0
+
+    def __init__(self, path: str, flush_interval: float = 1.0):
+        self.path = path
+        self.flush_interval = max(0.05, float(flush_interval))
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        for table in self.TABLES:
+            self._db.execute(f"CREATE TABLE IF NOT EXISTS {table} (key TEXT PRIMARY KEY, data TEXT NOT NULL)")
+        self._db.commit()
+        self._dirty: Dict[Tuple[str, str], Any] = {}
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="state")
+        self._task: Optional[asyncio.Task] = None
+        self._writing: Optional[Future] = None
+        self._last_prune = 0.0
+
+    def load(self, table: str) -> List[Tuple[str, Any]]:
+        rows = self._db.execute(f"SELECT key, data FROM {table}").fetchall()
+        return [(k, json.loads(v)) for k, v in rows]
+
+    def put(self, table: str, key: str, value: Any):
+        """Mark a row dirty; value is serialized when the batch is written, so later mutations are kept."""
+        self._dirty[(table, key)] = value
+        self._ensure_flusher()
+
+    def delete(self, table: str, key: str):
+        self._dirty[(table, key)] = None
+        self._ensure_flusher()
+
+    def _ensure_flusher(self):
+        if self._task is None or self._task.done():
+            try:
+                self._task = asyncio.get_running_loop().create_task(self._flusher())
+            except RuntimeError:
+                self.flush()
+
+    def _take_batch(self) -> List[Tuple[str, str, Optional[str]]]:
+        dirty, self._dirty = self._dirty, {}
+        return [(t, k, None if v is None else json.dumps(v, ensure_ascii=False, default=_json_default)) for (t, k), v in dirty.items()]
+
+    def _prune_before(self) -> Optional[float]:
+        now = CLOCK.time()
+        if now - self._last_prune < self.PRUNE_INTERVAL:
+            return None
+        self._last_prune = now
+        return now
+
+    def _write(self, batch: List[Tuple[str, str, Optional[str]]], prune_before: Optional[float] = None):
+        with self._db:
+            for table, key, data in batch:
+                if data is None:
+                    self._db.execute(f"DELETE FROM {table} WHERE key = ?", (key,))
+                else:
+                    self._db.execute(f"INSERT OR REPLACE INTO {table} (key, data) VALUES (?, ?)", (key, data))
+            if prune_before is not None:
+                for table in self.EXPIRING_TABLES:
+                    self._db.execute(f"DELETE FROM {table} WHERE CAST(data AS REAL) <= ?", (prune_before,))
+
+    def flush(self):
+        batch = self._take_batch()
+        if batch:
+            self._write(batch, self._prune_before())
+
+    async def _flusher(self):
+        try:
+            while True:
+                await asyncio.sleep(self.flush_interval)
+                batch = self._take_batch()
+                if not batch:
+                    return
+                self._writing = self._executor.submit(self._write, batch, self._prune_before())
+                try:
+                    # Shielded: cancelling us must not cancel a write that hasn't started yet.
+                    await asyncio.shield(asyncio.wrap_future(self._writing))
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    LOG.error("【状态保存失败】错误 %s", e, extra={"stage": "state", "error": str(e)})
+        except asyncio.CancelledError:
+            # Let the write in flight finish first: it shares the connection and holds older rows.
+            if self._writing is not None:
+                try:
+                    self._writing.result()
+                except Exception:
+                    pass
+            self.flush()
+            raise
+
+class TrafficRecorder:
+    """Append-only gzip JSON-lines log of LibraryChanged frames and the metadata fetched for them.
+
+    Lines are buffered and appended by a background task; every batch is a complete gzip
+    member, so a crash loses at most one interval and the file stays readable.
+    """
+
+    def __init__(self, path: str, flush_interval: float = 1.0):
+        self.path = path
+        self.flush_interval = max(0.05, float(flush_interval))
+        self._pending: List[str] = []
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="recorder")
+        self._task: Optional[asyncio.Task] = None
+
+    def write(self, kind: str, server: str, **fields):
+        # Serialized now: items are mutated later (cached haystacks) and must be logged as fetched.
+        self._pending.append(json.dumps({"t": CLOCK.time(), "k": kind, "s": server, **fields}, ensure_ascii=False, default=_json_default))
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_running_loop().create_task(self._flusher())
+
+    def _append(self, lines: List[str]):
+        with gzip.open(self.path, "at", encoding="utf-8") as f:
+            f.write("\n".join(lines) + "\n")
+
+    async def _flusher(self):
+        loop = asyncio.get_running_loop()
+        try:
+            while self._pending:
+                await asyncio.sleep(self.flush_interval)
+                lines, self._pending = self._pending, []
+                try:
+                    await loop.run_in_executor(self._executor, self._append, lines)
+                except Exception as e:
+                    LOG.error("【录制写入失败】错误 %s", e, extra={"stage": "record", "error": str(e)})
+        except asyncio.CancelledError:
+            if self._pending:
+                self._append(self._pending)
+                self._pending = []
+            raise
+
+    @staticmethod
+    def read(path: str) -> Iterator[Dict]:
+        """Records in order; a member cut short by a crash ends the log instead of failing it."""
+        with gzip.open(path, "rt", encoding="utf-8") as f:
+            try:
+                for line in f:
+                    if line.strip():
+                        yield json.loads(line)
+            except (EOFError, gzip.BadGzipFile, json.JSONDecodeError):
+                return
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: int):
+        self.rate = float(rate)
+        self.burst = max(1, int(burst))
+        self._tokens = float(self.burst)
+        self._stamp: Optional[float] = None
+
+    async def acquire(self):
+        if self.rate <= 0:
+            return
+        loop = asyncio.get_running_loop()
+        while True:
+            now = loop.time()
+            if self._stamp is not None:
+                self._tokens = min(self.burst, self._tokens + (now - self._stamp) * self.rate)
+            self._stamp = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return
+            await asyncio.sleep((1 - self._tokens) / self.rate)
+
+class DeliveryQueue:
+    """Outbound queue toward one OneBot endpoint with bounded concurrency, rate limiting and retries."""
+
+    RETRY_STATUS = (500, 502, 503, 504)
+
+    def __init__(self, url: str, cfg: Optional[Dict] = None, name: str = ""):
+        cfg = cfg or {}
+        self.url = url
+        self.name = name or url
+        try:
+            self.concurrency = max(1, int(cfg.get("concurrency", 2)))
+        except Exception:
+            self.concurrency = 2
+        try:
+            rate = float(cfg.get("rate_per_second", 2))
+        except Exception:
+            rate = 2.0
+        try:
+            burst = int(cfg.get("burst", 5))
+        except Exception:
+            burst = 5
+        try:
+            self.retries = max(0, int(cfg.get("retries", 3)))
+        except Exception:
+            self.retries = 3
+        try:
+            self.backoff = max(0.1, float(cfg.get("backoff_seconds", 1)))
+        except Exception:
+            self.backoff = 1.0
+        try:
+            self.timeout = max(1, int(cfg.get("timeout_seconds", 10)))
+        except Exception:
+            self.timeout = 10
+        try:
+            self.queue_size = max(1, int(cfg.get("queue_size", 10000)))
+        except Exception:
+            self.queue_size = 10000
+        self.bucket = TokenBucket(rate, burst)
+        # Separate from the Jellyfin session: retries are handled here and the Jellyfin token must not leak.
         self.session = requests.Session()
-        self.token = None
-        retry = Retry(total=3, backoff_factor=0.5, status_forcelist=(500, 502, 503, 504), allowed_methods=("GET", "POST"))
-        adapter = HTTPAdapter(max_retries=retry)
+        adapter = HTTPAdapter(max_retries=0, pool_connections=1, pool_maxsize=self.concurrency)
         self.session.mount("http://", adapter)
         self.session.mount("https://", adapter)
-        self._library_cache: Dict[str, Tuple[str, str]] = {}
-        self._ancestors_cache: Dict[str, List[Dict]] = {}
-        dedupe_cfg = (self.cfg.get("dedupe") or {})
+        self._executor = ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix="delivery")
+        self._lanes: List[asyncio.Queue] = []
+        self._workers: List[asyncio.Task] = []
+        # Called once a payload has its final outcome (sent, failed or dropped); not on shutdown.
+        self.on_done: Optional[Callable[[Dict], Any]] = None
+        self._m_success = METRICS.counter("notify_delivery_total", "Notifications by final delivery outcome", target=self.name, result="success")
+        self._m_failure = METRICS.counter("notify_delivery_total", "Notifications by final delivery outcome", target=self.name, result="failure")
+        self._m_dropped = METRICS.counter("notify_delivery_total", "Notifications by final delivery outcome", target=self.name, result="dropped")
+        self._m_retries = METRICS.counter("notify_delivery_retries_total", "Delivery attempts repeated after a 5xx, timeout or connection error", target=self.name)
+        self._m_queued = METRICS.histogram("notify_stage_seconds", "Time spent per pipeline stage", stage="delivery_queue")
+        self._m_deliver = METRICS.histogram("notify_stage_seconds", "Time spent per pipeline stage", stage="deliver")
+
+    def depth(self) -> int:
+        return sum(q.qsize() for q in self._lanes)
+
+    def _ensure_workers(self):
+        if not self._lanes:
+            size = max(1, self.queue_size // self.concurrency)
+            self._lanes = [asyncio.Queue(maxsize=size) for _ in range(self.concurrency)]
+        if self._workers and not any(t.done() for t in self._workers):
+            return
+        for t in self._workers:
+            t.cancel()
+        self._workers = [asyncio.create_task(self._worker(q)) for q in self._lanes]
+
+    def submit(self, payload: Dict, order_key: Optional[str] = None) -> bool:
+        """Queue a payload; payloads sharing an order_key are sent one after another, in order."""
+        self._ensure_workers()
+        if order_key:
+            lane = self._lanes[hash(order_key) % len(self._lanes)]
+        else:
+            lane = min(self._lanes, key=lambda q: q.qsize())
         try:
-            self.season_summary_delay = int(
-                dedupe_cfg.get("season_summary_delay_seconds")
-                or dedupe_cfg.get("season_summary_ttl_seconds", 300)
-            )
+            lane.put_nowait((payload, time.monotonic()))
+            return True
+        except asyncio.QueueFull:
+            self._m_dropped.inc()
+            subj = payload.get("subject") or "通知"
+            LOG.warning("【%s】发送队列已满，已丢弃", subj, extra={"subject": subj, "target": self.name, "stage": "delivery_queue"})
+            if self.on_done is not None:
+                self.on_done(payload)
+            return False
+
+    async def join(self):
+        for q in self._lanes:
+            await q.join()
+
+    async def _worker(self, q: asyncio.Queue):
+        while True:
+            payload, queued_at = await q.get()
+            started = time.monotonic()
+            self._m_queued.observe(started - queued_at)
+            try:
+                await self._send(payload)
+            except Exception as e:
+                self._m_failure.inc()
+                subj = payload.get("subject") or "通知"
+                LOG.error("【%s】转发异常~ %s", subj, e, extra={"subject": subj, "target": self.name, "stage": "deliver", "error": str(e)})
+            finally:
+                self._m_deliver.observe(time.monotonic() - started)
+                q.task_done()
+            if self.on_done is not None:
+                self.on_done(payload)
+
+    async def _send(self, payload: Dict):
+        subj = payload.get("subject") or "通知"
+        started = time.monotonic()
+        loop = asyncio.get_running_loop()
+        post = functools.partial(self._post, payload)
+        attempt = 0
+        while True:
+            await self.bucket.acquire()
+            try:
+                resp = await loop.run_in_executor(self._executor, post)
+                status, error = resp.status_code, None
+            except (requests.Timeout, requests.ConnectionError) as e:
+                status, error = None, e
+            if status is not None and status < 300:
+                self._m_success.inc()
+                LOG.info("【%s】转发成功~", subj, extra={"subject": subj, "target": self.name, "stage": "deliver", "duration_ms": round((time.monotonic() - started) * 1000, 1)})
+                return
+            retryable = status is None or status in self.RETRY_STATUS
+            if not retryable or attempt >= self.retries:
+                self._m_failure.inc()
+                if error is not None:
+                    LOG.error("【%s】转发异常~ %s", subj, error, extra={"subject": subj, "target": self.name, "stage": "deliver", "error": str(error)})
+                else:
+                    LOG.error("【%s】转发失败~ 状态码 %s", subj, status, extra={"subject": subj, "target": self.name, "stage": "deliver", "status": status})
+                return
+            attempt += 1
+            self._m_retries.inc()
+            await asyncio.sleep(self.backoff * (2 ** (attempt - 1)) * random.uniform(0.5, 1.5))
+
+    def _post(self, payload: Dict) -> requests.Response:
+        # On the delivery thread: embedding the poster reads the cache file.
+        return self.session.post(self.url, json=request_body(payload), timeout=self.timeout)
+
+class DigestBuffer:
+    """Pass payloads straight through until a burst exceeds the threshold within the window;
+    the rest of that window is collected and sent as one summary message."""
+
+    def __init__(self, send: Callable[[Dict, Optional[str]], Any], cfg: Optional[Dict] = None):
+        cfg = cfg or {}
+        self.send = send
+        self.enabled = bool(cfg.get("enabled", False))
+        try:
+            self.window = max(1.0, float(cfg.get("window_seconds", 60)))
+        except Exception:
+            self.window = 60.0
+        try:
+            self.threshold = max(1, int(cfg.get("threshold", 5)))
         except Exception:
-            self.season_summary_delay = 300
+            self.threshold = 5
         try:
-            self.movie_delay_seconds = int(dedupe_cfg.get("movie_delay_seconds", 300))
+            self.max_lines = max(1, int(cfg.get("max_lines", 20)))
         except Exception:
-            self.movie_delay_seconds = 300
-        self.season_summary_delay = max(1, self.season_summary_delay)
-        self.movie_delay_seconds = max(1, self.movie_delay_seconds)
-        self.episode_suppress_seconds = int(dedupe_cfg.get("episode_suppress_seconds", 1800))
-        self._season_batches: Dict[Tuple[str, int], Dict[str, Any]] = {}
+            self.max_lines = 20
+        self._recent: Deque[float] = deque()
+        self._pending: List[Tuple[Dict, Optional[str]]] = []
+        self._timer: Optional[asyncio.TimerHandle] = None
+
+    def add(self, payload: Dict, order_key: Optional[str] = None):
+        if not self.enabled:
+            self.send(payload, order_key)
+            return
+        if self._timer is not None:
+            self._pending.append((payload, order_key))
+            return
+        now = CLOCK.monotonic()
+        while self._recent and self._recent[0] <= now - self.window:
+            self._recent.popleft()
+        if len(self._recent) < self.threshold:
+            self._recent.append(now)
+            self.send(payload, order_key)
+            return
+        self._pending.append((payload, order_key))
+        self._timer = asyncio.get_running_loop().call_later(self.window, self._release)
+
+    def _release(self):
+        pending, self._pending, self._timer = self._pending, [], None
+        self._recent.clear()
+        self._recent.append(CLOCK.monotonic())
+        if len(pending) == 1:
+            self.send(*pending[0])
+        elif pending:
+            self.send(self.build_digest([p for p, _ in pending]), None)
+
+    def build_digest(self, payloads: List[Dict]) -> Dict:
+        subjects = [p.get("subject") or "通知" for p in payloads]
+        lines = [f"· {s}" for s in subjects[:self.max_lines]]
+        extra = len(subjects) - len(lines)
+        if extra > 0:
+            lines.append(f"…… 另有 {extra} 条更新")
+        msg = f"媒体库更新啦！（共 {len(subjects)} 条）\n" + "\n".join(lines)
+        digest = {"group_id": payloads[0].get("group_id"), "message": msg, "subject": f"更新汇总 {len(subjects)} 条"}
+        outbox = [k for p in payloads for k in p.get("outbox") or ()]
+        if outbox:
+            digest["outbox"] = outbox
+        return digest
+
+class RuleSnapshot(NamedTuple):
+    """The server's compiled rules and each target's (libraries, filter, policies), as of one moment."""
+    bot: Dict[str, Any]
+    targets: Tuple[Tuple["ForwardTarget", Tuple[Optional["PolicyMatcher"], "KeywordFilter", Optional["PolicyMatcher"]]], ...]
+
+class ForwardTarget:
+    """One OneBot endpoint and group, with its own library selection, policies, filters and delivery queue."""
+
+    def __init__(self, cfg: Dict, defaults: Dict):
+        self.forward_url = cfg.get("forward_url") or defaults.get("forward_url") or ""
+        self.group_id = cfg.get("group_id", defaults.get("group_id"))
+        self.name = str(cfg.get("name") or self.group_id or self.forward_url)
+        self.libraries, self.filter, self.policies = self.compile_rules(cfg)
+        self.delivery = DeliveryQueue(self.forward_url, {**(defaults.get("delivery") or {}), **(cfg.get("delivery") or {})}, self.name)
+        self.delivery.on_done = self._delivered
+        self.digest = DigestBuffer(self.delivery.submit, {**(defaults.get("digest") or {}), **(cfg.get("digest") or {})})
+        self.state: Optional[StateStore] = None
+        self._seq = 0
+
+    @staticmethod
+    def compile_rules(cfg: Dict) -> Tuple[Optional[PolicyMatcher], KeywordFilter, Optional[PolicyMatcher]]:
+        libs = [str(k).strip() for k in (cfg.get("libraries") or []) if str(k).strip()]
+        libraries = PolicyMatcher({k: {"mode": "selected"} for k in libs}) if libs else None
+        policies = RealtimeItemAdded._normalize_policies(cfg.get("library_policies") or [])
+        return libraries, KeywordFilter(cfg.get("filters")), PolicyMatcher(policies) if policies else None
+
+    def accepts(self, lib: Tuple[str, str], hay_lower: str, rules: Optional[Tuple[Optional[PolicyMatcher], KeywordFilter, Optional[PolicyMatcher]]] = None) -> bool:
+        libraries, keyword_filter, _ = rules if rules is not None else (self.libraries, self.filter, self.policies)
+        if libraries is not None and not libraries.match(*lib):
+            return False
+        return keyword_filter.passes(hay_lower)
+
+    def send(self, payload: Dict, order_key: Optional[str] = None):
+        """Queue a payload; with a state store it is kept in the outbox until it has been delivered."""
+        payload = {**payload, "group_id": self.group_id}
+        if self.state is not None:
+            self._seq += 1
+            key = f"{time.time_ns():020d}-{self._seq:06d}-{self.name}"
+            payload["outbox"] = [key]
+            self.state.put("outbox", key, {"target": self.name, "payload": payload, "order_key": order_key})
+        self.digest.add(payload, order_key)
+
+    def restore(self, payload: Dict, order_key: Optional[str] = None):
+        """Requeue a payload left in the outbox by a previous run; its row stays until delivery."""
+        self.digest.add({**payload, "group_id": self.group_id}, order_key)
+
+    def _delivered(self, payload: Dict):
+        if self.state is not None:
+            for key in payload.get("outbox") or ():
+                self.state.delete("outbox", key)
+
+def server_configs(cfg: Dict) -> List[Dict]:
+    """One config per Jellyfin server; entries under `servers` inherit every top-level setting."""
+    servers = [s for s in (cfg.get("servers") or []) if s and s.get("server_url")]
+    if not servers:
+        return [{**cfg, "name": ""}]
+    out = []
+    for s in servers:
+        name = str(s.get("name") or s["server_url"]).strip()
+        out.append({**cfg, **s, "name": name})
+    return out
+
+class NotifyHub:
+    """Delivery targets, batch scheduling and persisted state shared by every Jellyfin server."""
+
+    def __init__(self, cfg: Dict):
+        self.cfg = cfg
+        self.forward_url = cfg.get("forward_url")
+        self.group_id = cfg.get("group_id")
+        target_defaults = {
+            "forward_url": self.forward_url,
+            "group_id": self.group_id,
+            "delivery": cfg.get("delivery"),
+            "digest": cfg.get("digest"),
+        }
+        target_cfgs = cfg.get("targets") or [{}]
+        self.targets = [ForwardTarget(c or {}, target_defaults) for c in target_cfgs]
+        self.targets = [t for t in self.targets if t.forward_url]
+        # Routing, reload and the outbox all find a target by name.
+        names = [t.name for t in self.targets]
+        for name in names:
+            if names.count(name) > 1:
+                raise ValueError(f"duplicate target name: {name!r}; give each target its own name")
+        self.servers: Dict[str, "RealtimeItemAdded"] = {}
+        dedupe = self._parse_dedupe(cfg)
+        self._episode_sent_until = ExpiringSet(max(1, dedupe[2]), dedupe[3])
+        self._apply_dedupe(dedupe)
+        self._season_batches: Dict[Tuple[str, str, int], Dict[str, Any]] = {}
         self._season_lock: Optional[asyncio.Lock] = None
         self._season_flush_task: Optional[asyncio.Task] = None
         self._movie_queue: Dict[str, Dict[str, Any]] = {}
         self._movie_lock: Optional[asyncio.Lock] = None
+        self._season_deadlines: List[Tuple[float, Tuple[str, str, int]]] = []
+        self._movie_deadlines: List[Tuple[float, str]] = []
+        self._flush_wakeup: Optional[asyncio.Event] = None
+        self._flush_target = float("inf")
+        state_cfg = (cfg.get("state") or {})
+        state_path = state_cfg.get("path", "notify_state.db")
+        try:
+            state_interval = float(state_cfg.get("flush_interval_seconds", 1))
+        except Exception:
+            state_interval = 1.0
+        self.state: Optional[StateStore] = StateStore(str(state_path), state_interval) if state_path else None
+        for t in self.targets:
+            t.state = self.state
+        self.meta: Dict[str, Any] = {}
+        self._restore_task: Optional[asyncio.Task] = None
+        reload_cfg = (cfg.get("reload") or {})
+        self.reload_enabled = bool(reload_cfg.get("enabled", True))
+        try:
+            self.reload_interval = max(1.0, float(reload_cfg.get("interval_seconds", 5)))
+        except Exception:
+            self.reload_interval = 5.0
+        self._reload_lock: Optional[asyncio.Lock] = None
+        self._reload_task: Optional[asyncio.Task] = None
+        metrics_cfg = (cfg.get("metrics") or {})
+        self.metrics_enabled = bool(metrics_cfg.get("enabled", False))
+        self.metrics_host = str(metrics_cfg.get("host") or "127.0.0.1")
+        try:
+            self.metrics_port = int(metrics_cfg.get("port", 9108))
+        except Exception:
+            self.metrics_port = 9108
+        self._metrics_server: Optional[asyncio.AbstractServer] = None
+        record_cfg = (cfg.get("record") or {})
+        self.recorder: Optional[TrafficRecorder] = None
+        if record_cfg.get("enabled", False):
+            try:
+                record_interval = float(record_cfg.get("flush_interval_seconds", 1))
+            except Exception:
+                record_interval = 1.0
+            self.recorder = TrafficRecorder(str(record_cfg.get("path") or "notify_record.jsonl.gz"), record_interval)
+        images_cfg = (cfg.get("images") or {})
+        self.images: Optional[ImageCache] = None
+        if images_cfg.get("enabled", True):
+            try:
+                image_entries = int(images_cfg.get("max_entries", 2000))
+            except Exception:
+                image_entries = 2000
+            try:
+                image_bytes = int(float(images_cfg.get("max_mb", 200)) * 1048576)
+            except Exception:
+                image_bytes = 200 * 1048576
+            image_dir = str(images_cfg.get("path") or "image_cache")
+            try:
+                self.images = ImageCache(image_dir, image_entries, image_bytes)
+            except OSError as e:
+                LOG.error("【海报缓存目录不可用】%s 错误 %s，改为直接引用图片地址", image_dir, e, extra={"stage": "image", "error": str(e)})
+        self._m_batch_wait = METRICS.histogram("notify_stage_seconds", "Time spent per pipeline stage", stage="batch_wait")
+        self._m_batch_size = METRICS.histogram("notify_season_batch_size", "Episodes per flushed season batch", Metrics.SIZE_BUCKETS)
+        METRICS.set_collector("hub", self._collect_metrics)
+
+    def _collect_metrics(self) -> List[Tuple[str, str, str, Dict[str, str], float]]:
+        samples = [
+            ("notify_pending_seasons", "gauge", "Season batches waiting for their delay", {}, len(self._season_batches)),
+            ("notify_pending_episodes", "gauge", "Episodes held in pending season batches", {}, sum(len(e.get("episodes") or {}) for e in self._season_batches.values())),
+            ("notify_pending_movies", "gauge", "Movies waiting for their delay", {}, len(self._movie_queue)),
+            ("notify_suppressed_episodes", "gauge", "Episodes inside their suppression window", {}, len(self._episode_sent_until)),
+        ]
+        if self.images is not None:
+            samples.append(("notify_image_cache_lookups_total", "counter", "Poster cache lookups", {"result": "hit"}, self.images.hits))
+            samples.append(("notify_image_cache_lookups_total", "counter", "Poster cache lookups", {"result": "miss"}, self.images.misses))
+            samples.append(("notify_image_cache_entries", "gauge", "Posters in the on-disk cache", {}, len(self.images)))
+            samples.append(("notify_image_cache_bytes", "gauge", "Size of the on-disk poster cache", {}, self.images.bytes))
+        for t in self.targets:
+            samples.append(("notify_delivery_queue_depth", "gauge", "Notifications waiting to be sent", {"target": t.name}, t.delivery.depth()))
+        return samples
+
+    @staticmethod
+    def _parse_dedupe(cfg: Dict) -> Tuple[int, int, int, int]:
+        dedupe_cfg = (cfg.get("dedupe") or {})
+        try:
+            season_summary_delay = int(
+                dedupe_cfg.get("season_summary_delay_seconds")
+                or dedupe_cfg.get("season_summary_ttl_seconds", 300)
+            )
+        except Exception:
+            season_summary_delay = 300
+        try:
+            movie_delay_seconds = int(dedupe_cfg.get("movie_delay_seconds", 300))
+        except Exception:
+            movie_delay_seconds = 300
+        season_summary_delay = max(1, season_summary_delay)
+        movie_delay_seconds = max(1, movie_delay_seconds)
+        episode_suppress_seconds = int(dedupe_cfg.get("episode_suppress_seconds", 1800))
+        try:
+            suppress_cap = int(dedupe_cfg.get("episode_suppress_max_entries", 100000))
+        except Exception:
+            suppress_cap = 100000
+        return season_summary_delay, movie_delay_seconds, episode_suppress_seconds, suppress_cap
+
+    def _apply_dedupe(self, dedupe: Tuple[int, int, int, int]):
+        """Pending batches keep their due times; new delays apply to the next item queued."""
+        self.season_summary_delay, self.movie_delay_seconds, self.episode_suppress_seconds, self.episode_suppress_cap = dedupe
+        self._episode_sent_until.set_ttl(self.episode_suppress_seconds)
+        self._episode_sent_until.max_entries = max(0, int(self.episode_suppress_cap))
+
+    def register(self, bot: "RealtimeItemAdded"):
+        if bot.name in self.servers:
+            raise ValueError(f"duplicate server name: {bot.name!r}")
+        self.servers[bot.name] = bot
+
+    def _server_for(self, entry: Dict) -> "RealtimeItemAdded":
+        # Entries persisted before a server was renamed or removed fall back to the first one.
+        return self.servers.get(entry.get("server") or "") or next(iter(self.servers.values()))
+
+    def scoped(self, server: str, key: str) -> str:
+        """Namespace an item ID per server; the unnamed single-server setup keeps bare IDs."""
+        return f"{server}/{key}" if server else key
+
+    async def start_metrics(self):
+        if not self.metrics_enabled or self._metrics_server is not None:
+            return
+        try:
+            self._metrics_server = await METRICS.serve(self.metrics_host, self.metrics_port)
+        except OSError as e:
+            LOG.error("【指标服务启动失败】%s:%s 错误 %s", self.metrics_host, self.metrics_port, e, extra={"error": str(e)})
+            return
+        LOG.info("【指标服务】http://%s:%s/metrics", self.metrics_host, self.metrics_port)
+
+    async def run(self, bots: List["RealtimeItemAdded"]):
+        await self.start_metrics()
+        if self.reload_enabled:
+            self._reload_task = asyncio.create_task(self._config_watcher())
+        try:
+            asyncio.get_running_loop().add_signal_handler(signal.SIGHUP, lambda: asyncio.ensure_future(self.reload_config()))
+        except (AttributeError, NotImplementedError, RuntimeError):
+            pass
+        await asyncio.gather(*(b.run_ws() for b in bots))
+
+    def _prepare_reload(self) -> Tuple[Dict, Dict[str, Tuple], Dict[str, Tuple[Dict, Dict]], Tuple[int, int, int, int]]:
+        """Parse and compile a fresh config.yaml; raises without touching anything if it is unusable."""
+        cfg = load_config()
+        if not isinstance(cfg, dict):
+            raise ValueError("配置文件为空或格式错误")
+        server_cfgs = {c["name"]: c for c in server_configs(cfg)}
+        if set(server_cfgs) != set(self.servers):
+            raise ValueError("servers 列表变更需要重启生效")
+        self._validate_reload(cfg, server_cfgs)
+        target_defaults = {"group_id": cfg.get("group_id"), "forward_url": cfg.get("forward_url")}
+        target_rules: Dict[str, Tuple] = {}
+        for c in cfg.get("targets") or [{}]:
+            c = c or {}
+            group_id = c.get("group_id", target_defaults["group_id"])
+            forward_url = c.get("forward_url") or target_defaults["forward_url"] or ""
+            target_rules[str(c.get("name") or group_id or forward_url)] = ForwardTarget.compile_rules(c)
+        # Targets own delivery queues and are matched by name; adding or removing one needs a restart.
+        known = {t.name for t in self.targets}
+        target_rules = {name: rules for name, rules in target_rules.items() if name in known}
+        target_filters_on = any(target_rules.get(t.name, (t.libraries, t.filter, t.policies))[1].active for t in self.targets)
+        bot_rules = {
+            name: (server_cfgs[name], bot.compile_rules(server_cfgs[name], target_filters_on))
+            for name, bot in self.servers.items()
+        }
+        return cfg, target_rules, bot_rules, self._parse_dedupe(cfg)
+
+    # A section the running config has but the new file lacks usually means the file is half-saved.
+    RELOAD_KEPT_SECTIONS = ("library_policies", "filters", "targets")
+
+    @staticmethod
+    def _check_filters(fcfg: Any, where: str):
+        if fcfg is None:
+            return
+        if not isinstance(fcfg, dict):
+            raise ValueError(f"{where}.filters 应为字典")
+        for kind in ("whitelist", "blacklist"):
+            sub = fcfg.get(kind)
+            if sub is None:
+                continue
+            if not isinstance(sub, dict):
+                raise ValueError(f"{where}.filters.{kind} 应为字典")
+            if sub.get("keywords") is not None and not isinstance(sub["keywords"], list):
+                raise ValueError(f"{where}.filters.{kind}.keywords 应为列表")
+
+    @staticmethod
+    def _check_policies(policies: Any, where: str):
+        if policies is not None and not isinstance(policies, list):
+            raise ValueError(f"{where}.library_policies 应为列表")
+        for i, p in enumerate(policies or []):
+            if not isinstance(p, dict) or not (p.get("libraries") or p.get("library")):
+                raise ValueError(f"{where}.library_policies[{i}] 需要 library 或 libraries")
+            if p.get("libraries") is not None and not isinstance(p["libraries"], list):
+                raise ValueError(f"{where}.library_policies[{i}].libraries 应为列表")
+            if p.get("mode", "per_episode") not in POLICY_MODES:
+                raise ValueError(f"{where}.library_policies[{i}] 未知的 mode：{p.get('mode')}")
+
+    def _validate_reload(self, cfg: Dict, server_cfgs: Dict[str, Dict]):
+        """Reject configs that would silently change behaviour: lost sections, malformed policies or filters."""
+        for name, c in server_cfgs.items():
+            where = f"servers[{name}]" if name else "配置"
+            for key in ("server_url", "username"):
+                if not c.get(key):
+                    raise ValueError(f"{where} 缺少 {key}")
+            current = self.servers[name].cfg
+            for key in self.RELOAD_KEPT_SECTIONS:
+                if key in current and key not in c:
+                    raise ValueError(f"{where} 缺少 {key} 段，文件可能尚未保存完整")
+            self._check_policies(c.get("library_policies"), where)
+            self._check_filters(c.get("filters"), where)
+        targets = cfg.get("targets")
+        if targets is not None and not isinstance(targets, list):
+            raise ValueError("targets 应为列表")
+        seen: Dict[str, int] = {}
+        for i, t in enumerate(targets or []):
+            if t is None:
+                continue
+            if not isinstance(t, dict):
+                raise ValueError(f"targets[{i}] 应为字典")
+            name = str(t.get("name") or t.get("group_id", cfg.get("group_id")) or t.get("forward_url") or cfg.get("forward_url") or "")
+            if name in seen:
+                raise ValueError(f"targets[{i}] 与 targets[{seen[name]}] 同名（{name}），请设置不同的 name")
+            seen[name] = i
+            if t.get("libraries") is not None and not isinstance(t["libraries"], list):
+                raise ValueError(f"targets[{i}].libraries 应为列表")
+            self._check_policies(t.get("library_policies"), f"targets[{i}]")
+            self._check_filters(t.get("filters"), f"targets[{i}]")
+
+    async def reload_config(self):
+        if self._reload_lock is None:
+            self._reload_lock = asyncio.Lock()
+        async with self._reload_lock:
+            try:
+                cfg, target_rules, bot_rules, dedupe = await asyncio.get_running_loop().run_in_executor(None, self._prepare_reload)
+            except Exception as e:
+                LOG.warning("【重载配置失败】继续使用当前配置：%s", e, extra={"stage": "reload", "error": str(e)})
+                return
+            self.cfg = cfg
+            LOG.setLevel(log_level(cfg))
+            self._apply_dedupe(dedupe)
+            for t in self.targets:
+                if t.name in target_rules:
+                    t.libraries, t.filter, t.policies = target_rules[t.name]
+            for name, (server_cfg, rules) in bot_rules.items():
+                bot = self.servers[name]
+                bot.cfg = server_cfg
+                bot._apply_rules(rules)
+            LOG.info("【重载配置】已更新黑白名单、媒体库策略与去重设置", extra={"stage": "reload"})
+
+    def _config_mtime(self) -> Optional[int]:
+        try:
+            return os.stat(CONFIG_FILE).st_mtime_ns
+        except OSError:
+            return None
+
+    async def _config_watcher(self):
+        """Reload once a changed mtime has held for a whole poll, so an editor mid-save isn't read."""
+        last = self._config_mtime()
+        changed = None
+        try:
+            while True:
+                await asyncio.sleep(self.reload_interval)
+                mtime = self._config_mtime()
+                if mtime is None or mtime == last:
+                    changed = None
+                elif mtime != changed:
+                    changed = mtime
+                else:
+                    last, changed = mtime, None
+                    await self.reload_config()
+        except asyncio.CancelledError:
+            pass
+
+    def episode_suppressed(self, key: Optional[str]) -> bool:
+        if not key:
+            return False
+        if self._episode_sent_until.check_and_add(key):
+            return True
+        if self.state is not None:
+            self.state.put("episode_sent", key, self._episode_sent_until.expires_at(key))
+        return False
+
+    def _season_state_key(self, season_key: Tuple[str, str, int]) -> str:
+        server, sid, s_no = season_key
+        return json.dumps([server, sid, s_no] if server else [sid, s_no])
+
+    async def restore_state(self):
+        """Reload pending batches and suppression state once, however many servers ask."""
+        if self.state is None:
+            return
+        if self._restore_task is None:
+            self._restore_task = asyncio.create_task(self._restore_state())
+        await self._restore_task
+
+    async def _restore_state(self):
+        """Overdue batches flush right away."""
+        loop = asyncio.get_running_loop()
+        seasons, movies, episodes, meta, outbox = await asyncio.gather(*(
+            loop.run_in_executor(self.state._executor, self.state.load, table) for table in StateStore.TABLES
+        ))
+        await self._ensure_season_helpers()
+        if self._movie_lock is None:
+            self._movie_lock = asyncio.Lock()
+        self.meta = dict(meta)
+        now = CLOCK.time()
+        for key, expires in sorted(episodes, key=lambda row: row[1] or 0):
+            if expires and expires > now:
+                self._episode_sent_until.add(key, expires)
+            else:
+                self.state.delete("episode_sent", key)
+        async with self._season_lock:
+            for key, entry in seasons:
+                parts = json.loads(key)
+                server, sid, s_no = parts if len(parts) == 3 else ["", *parts]
+                season_key = (server, sid, int(s_no))
+                entry["episodes"] = {k: ItemRecord(v) for k, v in (entry.get("episodes") or {}).items()}
+                entry.setdefault("server", server)
+                self._season_batches[season_key] = entry
+                self._schedule_deadline(self._season_deadlines, entry.get("due_time", 0), season_key)
+        async with self._movie_lock:
+            for key, entry in movies:
+                entry["item"] = ItemRecord(entry.get("item") or {})
+                self._movie_queue[key] = entry
+                self._schedule_deadline(self._movie_deadlines, entry.get("due_time", 0), key)
+        targets = {t.name: t for t in self.targets}
+        requeued = 0
+        # Keys start with the enqueue time, so sorting restores the original order.
+        for key, entry in sorted(outbox, key=lambda row: row[0]):
+            t = targets.get(entry.get("target"))
+            if t is None:
+                self.state.delete("outbox", key)
+                continue
+            t.restore(entry.get("payload") or {}, entry.get("order_key"))
+            requeued += 1
+        if seasons or movies or requeued:
+            LOG.info("【恢复待推送】季度 %d 个 电影 %d 部 待发送消息 %d 条", len(seasons), len(movies), requeued, extra={"stage": "state"})
+
+    async def _ensure_season_helpers(self):
+        if self._season_lock is None:
+            self._season_lock = asyncio.Lock()
+        if self._flush_wakeup is None:
+            self._flush_wakeup = asyncio.Event()
+        if self._season_flush_task is None or self._season_flush_task.done():
+            self._season_flush_task = asyncio.create_task(self._season_batch_flusher())
+
+    def _schedule_deadline(self, heap: List[Tuple[float, Any]], due_time: float, key: Any):
+        """Record a due time; wake the flusher only if it is sleeping past this deadline."""
+        heapq.heappush(heap, (due_time, key))
+        if due_time < self._flush_target and self._flush_wakeup is not None:
+            self._flush_wakeup.set()
+
+    async def queue_season_summary(self, server: str, series_id: str, season_no: int, series_name: str, episodes: List[Dict], targets: Optional[List[str]] = None):
+        if not episodes:
+            return
+        await self._ensure_season_helpers()
+        wait = max(1, int(self.season_summary_delay))
+        season_key = (server, series_id or "", int(season_no or 0))
+        async with self._season_lock:
+            entry = self._season_batches.get(season_key)
+            if entry is None:
+                entry = {
+                    "server": server,
+                    "series_id": series_id,
+                    "season_no": int(season_no or 0),
+                    "series_name": series_name,
+                    "episodes": {},
+                    "created": CLOCK.time(),
+                    "due_time": CLOCK.time() + wait,
+                }
+                self._season_batches[season_key] = entry
+                self._schedule_deadline(self._season_deadlines, entry["due_time"], season_key)
+            else:
+                if series_name and not entry.get("series_name"):
+                    entry["series_name"] = series_name
+                # Only ever later than the deadline already in the heap; the flusher re-arms it.
+                entry["due_time"] = CLOCK.time() + wait
+            episodes_dict: Dict[str, ItemRecord] = entry["episodes"]
+            for ep in episodes:
+                ep_id = str(ep.get("Id") or ep.get("EpisodeId") or len(episodes_dict))
+                episodes_dict[ep_id] = ItemRecord.of(ep)
+            if targets is None or entry.get("targets", []) is None:
+                entry["targets"] = None
+            else:
+                entry["targets"] = sorted(set(entry.get("targets", [])) | set(targets))
+            if self.state is not None:
+                self.state.put("season_batches", self._season_state_key(season_key), entry)
+
+    async def _flush_due_batches(self):
+        if self._season_lock is None:
+            return
+        now = CLOCK.time()
+        ready: List[Dict[str, Any]] = []
+        async with self._season_lock:
+            heap = self._season_deadlines
+            while heap and heap[0][0] <= now:
+                _, key = heapq.heappop(heap)
+                entry = self._season_batches.get(key)
+                if entry is None or not entry.get("episodes"):
+                    continue
+                # Each batch keeps one heap entry; one extended since it was pushed goes back at its new due time.
+                if entry.get("due_time", 0) > now:
+                    heapq.heappush(heap, (entry["due_time"], key))
+                    continue
+                ready.append(self._season_batches.pop(key))
+                if self.state is not None:
+                    self.state.delete("season_batches", self._season_state_key(key))
+        for entry in ready:
+            episodes_dict: Dict[str, ItemRecord] = entry.get("episodes", {})
+            episodes_list = list(episodes_dict.values())
+            if not episodes_list:
+                continue
+            if "created" in entry:
+                self._m_batch_wait.observe(now - entry["created"])
+            self._m_batch_size.observe(len(episodes_list))
+            series_name = entry.get("series_name") or (episodes_list[0].get("SeriesName") or "")
+            season_no = entry.get("season_no")
+            series_id = entry.get("series_id") or (episodes_list[0].get("SeriesId") or "")
+            bot = self._server_for(entry)
+            if len(episodes_list) == 1:
+                payload = bot.build_payload(episodes_list[0])
+                await self.forward_async(payload, series_id, entry.get("targets"))
+            else:
+                payload = bot.build_season_payload(series_name, season_no, len(episodes_list), series_id)
+                await self.forward_async(payload, series_id, entry.get("targets"))
+
+    def _next_deadline(self) -> Optional[float]:
+        heads = [h[0][0] for h in (self._season_deadlines, self._movie_deadlines) if h]
+        return min(heads) if heads else None
+
+    async def _season_batch_flusher(self):
+        try:
+            while True:
+                due = self._next_deadline()
+                self._flush_target = due if due is not None else float("inf")
+                self._flush_wakeup.clear()
+                timeout = None if due is None else max(0.0, due - CLOCK.time())
+                try:
+                    await asyncio.wait_for(self._flush_wakeup.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+                await self._flush_due_batches()
+                await self._flush_due_movies()
+        except asyncio.CancelledError:
+            pass
+
+    async def queue_movie(self, server: str, item: Dict, targets: Optional[List[str]] = None):
+        await self._ensure_season_helpers()
+        if self._movie_lock is None:
+            self._movie_lock = asyncio.Lock()
+        if not item.get("Id"):
+            return
+        key = self.scoped(server, str(item["Id"]))
+        wait = max(1, int(self.movie_delay_seconds))
+        now = CLOCK.time()
+        async with self._movie_lock:
+            entry = self._movie_queue.get(key)
+            if entry is None:
+                entry = {"server": server, "item": ItemRecord.of(item), "created": now, "due_time": now + wait}
+                self._movie_queue[key] = entry
+                self._schedule_deadline(self._movie_deadlines, now + wait, key)
+            else:
+                entry["item"] = ItemRecord.of(item)
+            if targets is None or entry.get("targets", []) is None:
+                entry["targets"] = None
+            else:
+                entry["targets"] = sorted(set(entry.get("targets", [])) | set(targets))
+            if self.state is not None:
+                self.state.put("movie_queue", key, entry)
+
+    async def _flush_due_movies(self):
+        if self._movie_lock is None:
+            return
+        now = CLOCK.time()
+        ready: List[Dict[str, Any]] = []
+        async with self._movie_lock:
+            heap = self._movie_deadlines
+            while heap and heap[0][0] <= now:
+                _, k = heapq.heappop(heap)
+                entry = self._movie_queue.get(k)
+                if entry is None or entry.get("due_time", 0) > now:
+                    continue
+                ready.append(self._movie_queue.pop(k))
+                if self.state is not None:
+                    self.state.delete("movie_queue", k)
+        for entry in ready:
+            item = entry.get("item")
+            if item is None:
+                continue
+            if "created" in entry:
+                self._m_batch_wait.observe(now - entry["created"])
+            payload = self._server_for(entry).build_payload(item)
+            await self.forward_async(payload, None, entry.get("targets"))
+
+    async def forward_async(self, payload: Dict, order_key: Optional[str] = None, targets: Optional[List[str]] = None):
+        """Fan the payload out to the given targets (all of them when None)."""
+        if not self.targets:
+            LOG.warning("【未配置转发地址】已跳过", extra={"subject": payload.get("subject"), "stage": "deliver"})
+            return
+        for t in self.targets:
+            if targets is None or t.name in targets:
+                t.send(payload, order_key)
+
+class RealtimeItemAdded:
+
+    # /Items answers these when an ID in the list is malformed or gone.
+    BISECT_STATUS = (400, 404, 414)
+
+    def __init__(self, cfg: Optional[Dict] = None, hub: Optional[NotifyHub] = None):
+        self.cfg = cfg if cfg is not None else load_config()
+        self.name = str(self.cfg.get("name") or "")
+        self.server = self.cfg["server_url"].rstrip("/")
+        self.hub = hub if hub is not None else NotifyHub(self.cfg)
+        self.hub.register(self)
+        self.forward_url = self.hub.forward_url
+        self.group_id = self.hub.group_id
+        self.targets = self.hub.targets
+        self.recorder = self.hub.recorder
+        self.images = self.hub.images
+
         self._warned_libs: set[str] = set()
-        self._episode_sent_until: Dict[str, float] = {}
+        self._apply_rules(self.compile_rules(self.cfg, any(t.filter.active for t in self.targets)))
+        self.client = "Yukari Notify Bot"
+        self.device = "Yukari Notify Bot"
+        self.version = "1.0.0"
+        self.session = requests.Session()
+        self.token = None
+        http_cfg = (self.cfg.get("http") or {})
+        try:
+            self.http_pool_size = max(1, int(http_cfg.get("pool_size", 10)))
+        except Exception:
+            self.http_pool_size = 10
+        try:
+            self.http_timeout = max(1, int(http_cfg.get("timeout_seconds", 20)))
+        except Exception:
+            self.http_timeout = 20
+        retry = Retry(total=3, backoff_factor=0.5, status_forcelist=(500, 502, 503, 504), allowed_methods=("GET", "POST"))
+        adapter = HTTPAdapter(max_retries=retry, pool_connections=self.http_pool_size, pool_maxsize=self.http_pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self._http_executor: Optional[ThreadPoolExecutor] = None
+        cache_cfg = (self.cfg.get("cache") or {})
+        try:
+            cache_size = int(cache_cfg.get("max_entries", 5000))
+        except Exception:
+            cache_size = 5000
+        try:
+            cache_ttl = float(cache_cfg.get("ttl_seconds", 3600))
+        except Exception:
+            cache_ttl = 3600
+        self._ancestry = AncestryCache(cache_size, cache_ttl)
+        prewarm_cfg = (self.cfg.get("prewarm") or {})
+        self.prewarm_enabled = bool(prewarm_cfg.get("enabled", True))
+        try:
+            self.index_refresh_seconds = max(60, int(prewarm_cfg.get("refresh_seconds", 3600)))
+        except Exception:
+            self.index_refresh_seconds = 3600
+        self._library_index: Dict[str, Tuple[str, str]] = {}
+        self._index_task: Optional[asyncio.Task] = None
+        self.state = self.hub.state
+        backfill_cfg = (self.cfg.get("backfill") or {})
+        self.backfill_enabled = bool(backfill_cfg.get("enabled", True))
+        self.backfill_on_startup = bool(backfill_cfg.get("on_startup", True))
+        try:
+            self.backfill_page_size = max(1, int(backfill_cfg.get("page_size", 200)))
+        except Exception:
+            self.backfill_page_size = 200
+        self._high_water = ""
+        self._seen_items = ExpiringSet(86400, 100000)
+        self._backfill_task: Optional[asyncio.Task] = None
+        self._high_water_key = f"high_water:{self.name}" if self.name else "high_water"
+        ingest_cfg = (self.cfg.get("ingest") or {})
+        try:
+            self.ingest_workers = max(1, int(ingest_cfg.get("workers", 4)))
+        except Exception:
+            self.ingest_workers = 4
+        try:
+            self.ingest_queue_size = max(1, int(ingest_cfg.get("queue_size", 1000)))
+        except Exception:
+            self.ingest_queue_size = 1000
+        self.ingest_overflow = str(ingest_cfg.get("overflow") or "block").strip().lower()
+        if self.ingest_overflow not in ("block", "drop_oldest"):
+            self.ingest_overflow = "block"
+        try:
+            self.fetch_chunk_size = max(1, int(ingest_cfg.get("fetch_chunk_size", 100)))
+        except Exception:
+            self.fetch_chunk_size = 100
+        try:
+            self.fetch_concurrency = max(1, int(ingest_cfg.get("fetch_concurrency", 4)))
+        except Exception:
+            self.fetch_concurrency = 4
+        try:
+            self.coalesce_window = max(0.0, float(ingest_cfg.get("coalesce_window_seconds", 2)))
+        except Exception:
+            self.coalesce_window = 2.0
+        try:
+            self.coalesce_max_ids = max(1, int(ingest_cfg.get("coalesce_max_ids", 1000)))
+        except Exception:
+            self.coalesce_max_ids = 1000
+        images_cfg = (self.cfg.get("images") or {})
+        self.image_embed = str(images_cfg.get("embed") or "base64").strip().lower()
+        if self.image_embed not in ("base64", "file"):
+            self.image_embed = "base64"
+        try:
+            self.image_max_width = max(1, int(images_cfg.get("max_width", 600)))
+        except Exception:
+            self.image_max_width = 600
+        try:
+            self.image_quality = min(100, max(1, int(images_cfg.get("quality", 80))))
+        except Exception:
+            self.image_quality = 80
+        self._image_failed = ExpiringSet(600, 10000)
+        self._fetch_sem: Optional[asyncio.Semaphore] = None
+        self._frame_queue: Optional[asyncio.Queue] = None
+        self._shard_queues: List[asyncio.Queue] = []
+        self._ingest_tasks: List[asyncio.Task] = []
+        stage_help = "Time spent per pipeline stage"
+        self._m_frames = METRICS.counter("jellyfin_ws_frames_total", "LibraryChanged frames with added items", server=self.name)
+        self._m_skipped = METRICS.counter("jellyfin_ws_frames_skipped_total", "Frames dropped by MessageType triage without decoding", server=self.name)
+        self._m_items = METRICS.counter("notify_items_total", "Items fetched and handed to a worker", server=self.name)
+        self._m_req_items = METRICS.counter("jellyfin_requests_total", "Jellyfin API requests", server=self.name, endpoint="items")
+        self._m_req_ancestors = METRICS.counter("jellyfin_requests_total", "Jellyfin API requests", server=self.name, endpoint="ancestors")
+        self._m_req_images = METRICS.counter("jellyfin_requests_total", "Jellyfin API requests", server=self.name, endpoint="images")
+        self._m_index_hit = METRICS.counter("notify_library_index_lookups_total", "Library resolutions answered by the prewarmed index", server=self.name, result="hit")
+        self._m_index_miss = METRICS.counter("notify_library_index_lookups_total", "Library resolutions answered by the prewarmed index", server=self.name, result="miss")
+        self._m_receive = METRICS.histogram("notify_stage_seconds", stage_help, stage="ws_receive")
+        self._m_frame_queue = METRICS.histogram("notify_stage_seconds", stage_help, stage="frame_queue")
+        self._m_fetch = METRICS.histogram("notify_stage_seconds", stage_help, stage="fetch")
+        self._m_item_queue = METRICS.histogram("notify_stage_seconds", stage_help, stage="item_queue")
+        self._m_policy = METRICS.histogram("notify_stage_seconds", stage_help, stage="policy")
+        self._m_filter = METRICS.histogram("notify_stage_seconds", stage_help, stage="filter")
+        self._m_image = METRICS.histogram("notify_stage_seconds", stage_help, stage="image")
+        METRICS.set_collector(f"server:{self.name}", self._collect_metrics)
+
+    def _collect_metrics(self) -> List[Tuple[str, str, str, Dict[str, str], float]]:
+        server = {"server": self.name}
+        samples = [
+            ("notify_ancestry_cache_lookups_total", "counter", "Ancestor cache lookups", {**server, "result": "hit"}, self._ancestry.hits),
+            ("notify_ancestry_cache_lookups_total", "counter", "Ancestor cache lookups", {**server, "result": "miss"}, self._ancestry.misses),
+            ("notify_ancestry_cache_entries", "gauge", "Entries in the ancestor cache", server, len(self._ancestry)),
+            ("notify_library_index_entries", "gauge", "Libraries and top-level folders in the prewarmed index", server, len(self._library_index)),
+        ]
+        if self._frame_queue is not None:
+            samples.append(("notify_ingest_queue_depth", "gauge", "Frames or items waiting in the ingest queues", {**server, "queue": "frames"}, self._frame_queue.qsize()))
+            samples.append(("notify_ingest_queue_depth", "gauge", "Frames or items waiting in the ingest queues", {**server, "queue": "items"}, sum(q.qsize() for q in self._shard_queues)))
+        return samples
 
     def _episode_suppressed(self, item_id: Optional[str]) -> bool:
-        if not item_id:
-            return False
-        now = time.time()
-        stale = [k for k, exp in self._episode_sent_until.items() if exp <= now]
-        for k in stale:
-            self._episode_sent_until.pop(k, None)
-        exp = self._episode_sent_until.get(item_id)
-        if exp and exp > now:
-            return True
-        self._episode_sent_until[item_id] = now + max(1, int(self.episode_suppress_seconds))
-        return False
+        return self.hub.episode_suppressed(self.hub.scoped(self.name, item_id) if item_id else item_id)
 
+    async def restore_state(self):
+        await self.hub.restore_state()
+        self._high_water = self.hub.meta.get(self._high_water_key) or self._high_water
 
-    def _normalize_policies(self, arr):
+    async def _queue_season_summary(self, series_id: str, season_no: int, series_name: str, episodes: List[Dict], targets: Optional[List[str]] = None):
+        # Fetched while the batch waits, so the flush finds the poster already cached.
+        if episodes:
+            await self.prefetch_image(episodes[0])
+        await self.hub.queue_season_summary(self.name, series_id, season_no, series_name, episodes, targets)
+
+    async def _queue_movie(self, item: Dict, targets: Optional[List[str]] = None):
+        await self.prefetch_image(item)
+        await self.hub.queue_movie(self.name, item, targets)
+
+    async def forward_async(self, payload: Dict, order_key: Optional[str] = None, targets: Optional[List[str]] = None):
+        await self.hub.forward_async(payload, order_key, targets)
+
+    @staticmethod
+    def _normalize_policies(arr):
         """Expand to {libraryNameOrId: {mode}}; supports 'library' or 'libraries'."""
         policies: Dict[str, Dict] = {}
         for x in arr:
@@ -101,40 +1903,13 @@ class RealtimeItemAdded:
                 policies[key] = policy
         return policies
 
-    def _pick_policy(self, lib_id: str, lib_name: str):
+    def _pick_policy(self, lib_id: str, lib_name: str, rules: Optional[Dict[str, Any]] = None):
         """Prefer library ID, then name."""
-        p = self.library_policies.get(lib_id)
-        if p:
-            return p
-        p = self.library_policies.get(lib_name)
-        if p:
-            return p
-        norm = self._norm_name(lib_name)
-        p = self.library_policies_norm.get(norm)
-        if p:
-            return p
-        if norm:
-            for k, v in self.library_policies_norm.items():
-                if not k:
-                    continue
-                if k in norm or norm in k:
-                    return v
-        return None
+        matcher = rules["policy_matcher"] if rules is not None else self.policy_matcher
+        return matcher.match(lib_id, lib_name)
 
     def _norm_name(self, s: Optional[str]) -> str:
-        if not s:
-            return ""
-        table = str.maketrans({
-            "（": "(",
-            "）": ")",
-            "【": "[",
-            "】": "]",
-            "｛": "{",
-            "｝": "}",
-        })
-        out = s.translate(table)
-        out = out.replace("\u3000", " ").strip().lower()
-        return out
+        return norm_name(s)
 
     def login(self):
         headers = {
@@ -150,130 +1925,232 @@ class RealtimeItemAdded:
         data = r.json()
         self.token = data["AccessToken"]
         self.session.headers.update({"X-Emby-Token": self.token})
-        dest_out = self.forward_url or "未配置"
-        gid_out = str(self.group_id) if self.group_id is not None else "未配置"
-        print("已连接到 Jellyfin")
-        print(f"通知目标: [{dest_out}]")
-        print(f"群号: [{gid_out}]")
-        print("Kira~")
-
-    def get_items_by_ids(self, ids: List[str]) -> List[Dict]:
-        if not ids:
-            return []
-        r = None
-        try:
-            r = self.session.get(
-                f"{self.server}/Items",
-                params={
-                    "ids": ",".join(ids),
-                    "enableImages": "true",
-                    "fields": ",".join(
-                        [
-                            "SeriesId",
-                            "SeriesName",
-                            "SeasonId",
-                            "ParentId",
-                            "ParentIndexNumber",
-                            "IndexNumber",
-                            "ProductionYear",
-                            "RunTimeTicks",
-                            "Overview",
-                            "Path",
-                            "Album",
-                            "AlbumArtist",
-                            "Artists",
-                            "MediaType",
-                        ]
-                    ),
-                },
-                timeout=20,
-            )
-            r.raise_for_status()
-            data = r.json()
-            return data.get("Items") or data.get("items") or []
+        if self.name:
+            LOG.info("已连接到 Jellyfin [%s]", self.name, extra={"server": self.name})
+        else:
+            LOG.info("已连接到 Jellyfin")
+        if not self.targets:
+            LOG.info("通知目标: [未配置]")
+        for t in self.targets:
+            gid_out = str(t.group_id) if t.group_id is not None else "未配置"
+            LOG.info("通知目标: [%s] 群号: [%s]", t.forward_url, gid_out, extra={"target": t.name})
+        LOG.info("Kira~")
+
+    def _fetch_items(self, ids: List[str], fields: Tuple[str, ...] = ITEM_FIELDS) -> List[Dict]:
+        r = self.session.get(
+            f"{self.server}/Items",
+            params={
+                "ids": ",".join(ids),
+                "fields": ",".join(fields),
+                **self._image_query(fields == ITEM_FIELDS),
+            },
+            timeout=self.http_timeout,
+        )
+        r.raise_for_status()
+        data = r.json()
+        return data.get("Items") or data.get("items") or []
+
+    def _image_query(self, default: bool) -> Dict[str, str]:
+        """Ask for the primary image tags the poster cache is keyed by, and nothing else image-related."""
+        if self.images is None:
+            return {"enableImages": "true" if default else "false"}
+        return {"enableImages": "true", "enableImageTypes": "Primary", "imageTypeLimit": "1"}
+
+    def _fetch_items_since(self, min_created: str, start: int) -> List[Dict]:
+        r = self.session.get(
+            f"{self.server}/Items",
+            params={
+                "Recursive": "true",
+                "MinDateCreated": min_created,
+                "SortBy": "DateCreated,SortName",
+                "SortOrder": "Ascending",
+                "IncludeItemTypes": "Episode,Movie,MusicAlbum",
+                "StartIndex": start,
+                "Limit": self.backfill_page_size,
+                "EnableTotalRecordCount": "false",
+                "fields": ",".join(self._all_fields),
+                **self._image_query(False),
+            },
+            timeout=self.http_timeout,
+        )
+        r.raise_for_status()
+        data = r.json()
+        return data.get("Items") or data.get("items") or []
+
+    def _status_code_of(self, e: Exception) -> Optional[int]:
+        response = getattr(e, "response", None)
+        if isinstance(e, requests.RequestException) and response is not None:
+            return response.status_code
+        return None
+
+    def load_library_index(self) -> Dict[str, Tuple[str, str]]:
+        """Map every library and its top-level folders (series, movie folders...) to the library."""
+        index: Dict[str, Tuple[str, str]] = {}
+        r = self.session.get(f"{self.server}/Library/VirtualFolders", timeout=self.http_timeout)
+        r.raise_for_status()
+        for vf in r.json() or []:
+            lib_id = vf.get("ItemId") or vf.get("Id") or ""
+            lib_name = vf.get("Name") or ""
+            if not lib_id:
+                continue
+            lib = (lib_id, lib_name)
+            index[lib_id] = lib
+            start = 0
+            while True:
+                r = self.session.get(
+                    f"{self.server}/Items",
+                    params={
+                        "ParentId": lib_id,
+                        "StartIndex": start,
+                        "Limit": INDEX_PAGE_SIZE,
+                        "EnableImages": "false",
+                        "EnableUserData": "false",
+                        "EnableTotalRecordCount": "false",
+                    },
+                    timeout=self.http_timeout,
+                )
+                r.raise_for_status()
+                data = r.json()
+                page = data.get("Items") or data.get("items") or []
+                for it in page:
+                    if it.get("Id"):
+                        index[it["Id"]] = lib
+                if len(page) < INDEX_PAGE_SIZE:
+                    break
+                start += len(page)
+        return index
+
+    async def refresh_library_index(self):
+        try:
+            index = await self._run_blocking(self.load_library_index)
         except Exception as e:
-            status_code = None
-            try:
-                import requests as _rq
-                if isinstance(e, _rq.RequestException) and getattr(e, "response", None) is not None:
-                    status_code = e.response.status_code
-            except Exception:
-                pass
-            if status_code is None and r is not None:
-                status_code = getattr(r, "status_code", None)
-            ts = time.strftime("%Y-%m-%d %H:%M:%S")
-            print(f"[{ts}]【获取Items失败】状态码 {status_code} 错误 {e}")
-            return []
+            LOG.error("【预加载媒体库失败】状态码 %s 错误 %s", self._status_code_of(e), e, extra={"server": self.name, "stage": "prewarm", "status": self._status_code_of(e), "error": str(e)})
+            return
+        self._library_index = index
+        if self.recorder is not None:
+            self.recorder.write("index", self.name, index=index)
+        LOG.info("【预加载媒体库】%d 个目录", len(index), extra={"server": self.name, "stage": "prewarm", "count": len(index)})
 
-    def get_library_of_item(self, item_id: str) -> Tuple[str, str]:
-        if item_id in self._library_cache:
-            return self._library_cache[item_id]
-        r = None
+    async def _library_index_refresher(self):
         try:
-            r = self.session.get(f"{self.server}/Items/{item_id}/Ancestors", timeout=15)
+            while True:
+                await asyncio.sleep(self.index_refresh_seconds)
+                await self.refresh_library_index()
+        except asyncio.CancelledError:
+            pass
+
+    def _fetch_ancestors(self, item_key: str) -> Optional[List[Dict]]:
+        try:
+            r = self.session.get(f"{self.server}/Items/{item_key}/Ancestors", timeout=self.http_timeout)
             r.raise_for_status()
-            lib = ("", "")
-            for a in r.json() or []:
-                if a.get("Type") == "CollectionFolder":
-                    lib = (a.get("Id") or "", a.get("Name") or "")
-                    break
-            self._library_cache[item_id] = lib
-            return lib
+            return r.json() or []
+        except Exception as e:
+            LOG.error("【获取库信息失败】Item %s 状态码 %s 错误 %s", item_key, self._status_code_of(e), e, extra={"server": self.name, "item": item_key, "stage": "ancestors", "status": self._status_code_of(e), "error": str(e)})
+            return None
+
+    async def _ancestry_of_async(self, item_key: str) -> Optional[AncestryEntry]:
+        return await self._ancestry.get_or_load(item_key, lambda: self._load_ancestors_async(item_key))
+
+    async def _load_ancestors_async(self, item_key: str) -> Optional[List[Dict]]:
+        self._m_req_ancestors.inc()
+        ancestors = await self._run_blocking(self._fetch_ancestors, item_key)
+        if ancestors is not None and self.recorder is not None:
+            self.recorder.write("ancestors", self.name, key=item_key, ancestors=ancestors)
+        return ancestors
+
+    async def _run_blocking(self, fn, *args):
+        """Run a blocking Jellyfin call on the HTTP pool so the event loop keeps going."""
+        if self._http_executor is None:
+            self._http_executor = ThreadPoolExecutor(max_workers=self.http_pool_size, thread_name_prefix="jellyfin-http")
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._http_executor, functools.partial(fn, *args))
+
+    async def _fetch_chunk_async(self, ids: List[str], fields: Tuple[str, ...] = ITEM_FIELDS) -> List[Dict]:
+        """Fetch one chunk; a chunk rejected for its IDs is bisected so only the bad IDs are lost.
+
+        Transport errors and 5xx say nothing about the IDs (urllib3 has already retried them),
+        so the whole chunk fails at once instead of fanning out into one request per ID.
+        """
+        if self._fetch_sem is None:
+            self._fetch_sem = asyncio.Semaphore(self.fetch_concurrency)
+        self._m_req_items.inc()
+        try:
+            async with self._fetch_sem:
+                items = await self._run_blocking(self._fetch_items, ids, fields)
         except Exception as e:
-            status_code = None
+            status = self._status_code_of(e)
+            if len(ids) == 1:
+                LOG.error("【获取Items失败】Item %s 状态码 %s 错误 %s", ids[0], status, e, extra={"server": self.name, "item": ids[0], "stage": "fetch", "status": status, "error": str(e)})
+                return []
+            if status not in self.BISECT_STATUS:
+                LOG.error("【获取Items失败】%d 个条目 状态码 %s 错误 %s", len(ids), status, e, extra={"server": self.name, "stage": "fetch", "status": status, "count": len(ids), "error": str(e)})
+                return []
+        else:
+            if self.recorder is not None:
+                self.recorder.write("items", self.name, items=items)
+            return items
+        mid = len(ids) // 2
+        left, right = await asyncio.gather(self._fetch_chunk_async(ids[:mid], fields), self._fetch_chunk_async(ids[mid:], fields))
+        return left + right
+
+    async def iter_items_by_ids_async(self, ids: List[str], fields: Tuple[str, ...] = ITEM_FIELDS) -> AsyncIterator[List[Dict]]:
+        """Yield fetched items chunk by chunk, in request order, while later chunks are still in flight."""
+        if not ids:
+            return
+
+        async def fetch(chunk: List[str]) -> List[Dict]:
+            started = time.monotonic()
             try:
-                import requests as _rq
-                if isinstance(e, _rq.RequestException) and getattr(e, "response", None) is not None:
-                    status_code = e.response.status_code
-            except Exception:
-                pass
-            if status_code is None and r is not None:
-                status_code = getattr(r, "status_code", None)
-            ts = time.strftime("%Y-%m-%d %H:%M:%S")
-            print(f"[{ts}]【获取库信息失败】Item {item_id} 状态码 {status_code} 错误 {e}")
-            return "", ""
+                return await self._fetch_chunk_async(chunk, fields)
+            finally:
+                self._m_fetch.observe(time.monotonic() - started)
+
+        size = self.fetch_chunk_size
+        tasks = [asyncio.create_task(fetch(ids[i:i + size])) for i in range(0, len(ids), size)]
+        try:
+            for task in tasks:
+                yield await task
+        finally:
+            for task in tasks:
+                task.cancel()
 
-    def get_library_for(self, item: Dict) -> Tuple[str, str]:
-        """Resolve library using SeriesId/ParentId when possible to reuse cache."""
+    async def get_library_for_async(self, item: Dict) -> Tuple[str, str]:
         key = item.get("SeriesId") or item.get("ParentId") or item.get("Id")
         if not key:
             return "", ""
-        if key in self._library_cache:
-            return self._library_cache[key]
-        lib = self.get_library_of_item(key)
-        item_id = item.get("Id")
-        if item_id and item_id not in self._library_cache:
-            self._library_cache[item_id] = lib
-        return lib
-
-    def get_ancestors(self, item_key: str) -> List[Dict]:
+        lib = self._library_index.get(key)
+        if lib:
+            self._m_index_hit.inc()
+            return lib
+        self._m_index_miss.inc()
+        entry = await self._ancestry_of_async(key)
+        return entry.library if entry else ("", "")
+
+    async def get_ancestors_async(self, item_key: str) -> List[Dict]:
         if not item_key:
             return []
-        if item_key in self._ancestors_cache:
-            return self._ancestors_cache[item_key]
-        r = None
-        try:
-            r = self.session.get(f"{self.server}/Items/{item_key}/Ancestors", timeout=15)
-            r.raise_for_status()
-            arr = r.json() or []
-            self._ancestors_cache[item_key] = arr
-            return arr
-        except Exception:
-            return []
+        entry = await self._ancestry_of_async(item_key)
+        return entry.ancestors if entry else []
 
-    def _pick_policy_for_item(self, item: Dict):
+    async def _pick_policy_for_item_async(self, item: Dict, rules: Optional[Dict[str, Any]] = None):
         key = item.get("SeriesId") or item.get("ParentId") or item.get("Id")
-        ancestors = self.get_ancestors(key)
+        lib = self._library_index.get(key)
+        if lib:
+            return self._pick_policy(*lib, rules)
+        ancestors = await self.get_ancestors_async(key)
         for a in ancestors:
             pid = a.get("Id") or ""
             pname = a.get("Name") or ""
-            pol = self._pick_policy(pid, pname)
+            pol = self._pick_policy(pid, pname, rules)
             if pol:
                 return pol
-        lib_id, lib_name = self.get_library_for(item)
-        return self._pick_policy(lib_id, lib_name)
+        lib_id, lib_name = await self.get_library_for_async(item)
+        return self._pick_policy(lib_id, lib_name, rules)
 
     def _hay_from_item(self, item: Dict) -> str:
+        hay = item.get("_hay")
+        if hay is not None:
+            return hay
         parts = [
             item.get("Name"),
             item.get("SeriesName"),
@@ -285,125 +2162,27 @@ class RealtimeItemAdded:
             item.get("AlbumArtist"),
             ", ".join(item.get("Artists", [])) if item.get("Artists") else None,
         ]
-        return " ".join(str(x) for x in parts if x).lower()
+        hay = " ".join(str(x) for x in parts if x).lower()
+        item["_hay"] = hay
+        return hay
 
     def _hay_for_series(self, series_name: str, example_item: Dict) -> str:
         parts = [series_name, example_item.get("Path")]
         return " ".join(str(x) for x in parts if x).lower()
 
-    def _pass_filters(self, hay_lower: str) -> bool:
-        if self.blacklist_enabled and self.blacklist:
-            if any(k in hay_lower for k in self.blacklist):
-                return False
-        if self.whitelist_enabled:
-            if not self.whitelist or not any(k in hay_lower for k in self.whitelist):
-                return False
-        return True
-
-    async def _ensure_season_helpers(self):
-        if self._season_lock is None:
-            self._season_lock = asyncio.Lock()
-        if self._season_flush_task is None or self._season_flush_task.done():
-            self._season_flush_task = asyncio.create_task(self._season_batch_flusher())
-
-    async def _queue_season_summary(self, series_id: str, season_no: int, series_name: str, episodes: List[Dict]):
-        if not episodes:
-            return
-        await self._ensure_season_helpers()
-        wait = max(1, int(self.season_summary_delay))
-        season_key = (series_id or "", int(season_no or 0))
-        async with self._season_lock:
-            entry = self._season_batches.get(season_key)
-            if entry is None:
-                entry = {
-                    "series_id": series_id,
-                    "season_no": int(season_no or 0),
-                    "series_name": series_name,
-                    "episodes": {},
-                    "due_time": time.time() + wait,
-                }
-                self._season_batches[season_key] = entry
-            else:
-                if series_name and not entry.get("series_name"):
-                    entry["series_name"] = series_name
-                entry["due_time"] = time.time() + wait
-            episodes_dict: Dict[str, Dict] = entry["episodes"]
-            for ep in episodes:
-                ep_id = str(ep.get("Id") or ep.get("EpisodeId") or len(episodes_dict))
-                episodes_dict[ep_id] = ep
-
-    async def _flush_due_batches(self):
-        if self._season_lock is None:
-            return
-        now = time.time()
-        ready: List[Dict[str, Any]] = []
-        async with self._season_lock:
-            due_keys = []
-            for key, entry in self._season_batches.items():
-                due_time = entry.get("due_time")
-                if due_time and due_time <= now and entry.get("episodes"):
-                    due_keys.append(key)
-            for key in due_keys:
-                entry = self._season_batches.pop(key, None)
-                if entry:
-                    ready.append(entry)
-        for entry in ready:
-            episodes_dict: Dict[str, Dict] = entry.get("episodes", {})
-            episodes_list = list(episodes_dict.values())
-            if not episodes_list:
-                continue
-            series_name = entry.get("series_name") or (episodes_list[0].get("SeriesName") or "")
-            season_no = entry.get("season_no")
-            series_id = entry.get("series_id") or (episodes_list[0].get("SeriesId") or "")
-            if len(episodes_list) == 1:
-                payload = self.build_payload(episodes_list[0])
-                await self.forward_async(payload)
-            else:
-                payload = self.build_season_payload(series_name, season_no, len(episodes_list), series_id)
-                await self.forward_async(payload)
-
-    async def _season_batch_flusher(self):
-        try:
-            while True:
-                await asyncio.sleep(5)
-                await self._flush_due_batches()
-                await self._flush_due_movies()
-        except asyncio.CancelledError:
-            pass
-
-    async def _queue_movie(self, item: Dict):
-        await self._ensure_season_helpers()
-        if self._movie_lock is None:
-            self._movie_lock = asyncio.Lock()
-        key = str(item.get("Id") or "")
-        if not key:
-            return
-        wait = max(1, int(self.movie_delay_seconds))
-        now = time.time()
-        async with self._movie_lock:
-            entry = self._movie_queue.get(key)
-            if entry is None:
-                self._movie_queue[key] = {"item": item, "due_time": now + wait}
-            else:
-                entry["item"] = item
+    def _snapshot_rules(self) -> "RuleSnapshot":
+        return RuleSnapshot(self.rules, tuple((t, (t.libraries, t.filter, t.policies)) for t in self.targets))
 
-    async def _flush_due_movies(self):
-        if self._movie_lock is None:
-            return
-        now = time.time()
-        ready: List[Dict[str, Any]] = []
-        async with self._movie_lock:
-            due_keys = [k for k, v in self._movie_queue.items() if v.get("due_time", 0) <= now]
-            for k in due_keys:
-                entry = self._movie_queue.pop(k, None)
-                if entry:
-                    ready.append(entry)
-        for entry in ready:
-            item = entry.get("item") or {}
-            if not self._pass_filters(self._hay_from_item(item)):
-                continue
-            payload = self.build_payload(item)
-            await self.forward_async(payload)
+    def _admit(self, lib: Tuple[str, str], hay_lower: str, rules: "RuleSnapshot", allowed: Optional[Set[str]] = None) -> List[str]:
+        """Names of the targets (of `allowed`, if given) that want this item; empty if the global filters reject it."""
+        started = time.monotonic()
+        if rules.bot["keyword_filter"].passes(hay_lower):
+            names = [t.name for t, target_rules in rules.targets
+                     if (allowed is None or t.name in allowed) and t.accepts(lib, hay_lower, target_rules)]
+        else:
+            names = []
+        self._m_filter.observe(time.monotonic() - started)
+        return names
 
     def build_payload(self, item: Dict) -> Dict:
         t = (item.get("Type") or "").strip()
@@ -454,181 +2233,660 @@ class RealtimeItemAdded:
             msg = title + (f"\n时长：{dur}" if dur else "")
             image_item_id = item.get("Id")
 
-        image_url = f"{self.server}/Items/{image_item_id}/Images/Primary"
-        payload = {"group_id": self.group_id, "message": f"{msg}\n[CQ:image,file={image_url}]", "subject": subject}
+        image, poster = self._image_cq(image_item_id)
+        payload = {"group_id": self.group_id, "message": f"{msg}\n{image}", "subject": subject}
+        if poster is not None:
+            payload["poster"] = poster
         return payload
 
     def build_season_payload(self, series_name: str, season_no: int, ep_count: int, series_id: str) -> Dict:
         title = f"{series_name} 更新啦！\n第{int(season_no):02d}季（共 {ep_count} 集）"
-        image_url = f"{self.server}/Items/{series_id}/Images/Primary"
-        payload = {"group_id": self.group_id, "message": f"{title}\n[CQ:image,file={image_url}]", "subject": f"{series_name} S{int(season_no):02d} 合集"}
+        image, poster = self._image_cq(series_id)
+        payload = {"group_id": self.group_id, "message": f"{title}\n{image}", "subject": f"{series_name} S{int(season_no):02d} 合集"}
+        if poster is not None:
+            payload["poster"] = poster
         return payload
 
-    async def forward_async(self, payload: Dict):
-        if not self.forward_url:
-            ts = time.strftime("%Y-%m-%d %H:%M:%S")
-            print(f"[{ts}]【未配置转发地址】已跳过")
+    def _image_source(self, item: Dict) -> Tuple[str, str]:
+        """The item whose primary image the notification shows (the series for episodes) and its tag."""
+        if (item.get("Type") or "").strip() == "Episode" and item.get("SeriesId"):
+            return item["SeriesId"], item.get("SeriesPrimaryImageTag") or ""
+        return item.get("Id") or "", (item.get("ImageTags") or {}).get("Primary") or ""
+
+    def _image_params(self, tag: str) -> Dict[str, Any]:
+        params: Dict[str, Any] = {"maxWidth": self.image_max_width, "quality": self.image_quality, "format": "Jpg"}
+        if tag:
+            params["tag"] = tag
+        return params
+
+    def _fetch_image(self, image_id: str, tag: str, dest: str) -> int:
+        r = self.session.get(f"{self.server}/Items/{image_id}/Images/Primary", params=self._image_params(tag), timeout=self.http_timeout)
+        r.raise_for_status()
+        if not r.content:
+            raise ValueError("empty image")
+        tmp = dest + ".tmp"
+        with open(tmp, "wb") as f:
+            f.write(r.content)
+        os.replace(tmp, dest)
+        return len(r.content)
+
+    async def prefetch_image(self, item: Dict):
+        """Image stage: fetch the poster this item's notification will show into the cache, once per tag."""
+        if self.images is None:
             return
-        subj = payload.get("subject") or "通知"
+        image_id, tag = self._image_source(item)
+        if not image_id:
+            return
+        key = self.hub.scoped(self.name, image_id)
+        if key in self._image_failed:
+            return
+
+        async def load(dest: str) -> Optional[int]:
+            self._m_req_images.inc()
+            try:
+                return await self._run_blocking(self._fetch_image, image_id, tag, dest)
+            except Exception as e:
+                # Items without a poster answer 404; don't ask again for every episode.
+                self._image_failed.add(key)
+                LOG.warning("【获取海报失败】Item %s 状态码 %s 错误 %s，改为直接引用图片地址", image_id, self._status_code_of(e), e, extra={"server": self.name, "item": image_id, "stage": "image", "status": self._status_code_of(e), "error": str(e)})
+                return None
+
+        started = time.monotonic()
         try:
-            resp = await asyncio.to_thread(self.session.post, self.forward_url, json=payload, timeout=10)
-            ts = time.strftime("%Y-%m-%d %H:%M:%S")
-            if resp.status_code < 300:
-                print(f"[{ts}]【{subj}】转发成功~")
-            else:
-                print(f"[{ts}]【{subj}】转发失败~ 状态码 {resp.status_code}")
-        except Exception as e:
-            ts = time.strftime("%Y-%m-%d %H:%M:%S")
-            print(f"[{ts}]【{subj}】转发异常~ {e}")
+            await self.images.get_or_load(key, tag, load)
+        finally:
+            self._m_image.observe(time.monotonic() - started)
+
+    def _image_cq(self, image_id: str) -> Tuple[str, Optional[Dict[str, str]]]:
+        """CQ image code for the poster, and the poster request_body resolves at send time.
+
+        Queued payloads only hold the file:// reference; the delivery thread swaps in the content
+        just before posting, so thousands of waiting messages don't each carry a poster. With
+        embed: file the reference is kept unless the cache evicted the file in the meantime.
+        """
+        url = f"{self.server}/Items/{image_id}/Images/Primary"
+        if self.images is None:
+            return f"[CQ:image,file={cq_escape(url)}]", None
+        resized = cq_escape(f"{url}?{urllib.parse.urlencode(self._image_params(''))}")
+        path = self.images.lookup(self.hub.scoped(self.name, image_id))
+        if path is None:
+            return f"[CQ:image,file={resized}]", None
+        ref = cq_escape("file://" + os.path.abspath(path))
+        return f"[CQ:image,file={ref}]", {"ref": ref, "path": path, "url": resized, "embed": self.image_embed}
 
     def forward(self, payload: Dict):
         if not self.forward_url:
-            ts = time.strftime("%Y-%m-%d %H:%M:%S")
-            print(f"[{ts}]，[未配置转发地址]，已跳过")
+            LOG.warning("，[未配置转发地址]，已跳过")
             return
         subj = payload.get("subject") or "通知"
         try:
-            resp = self.session.post(self.forward_url, json=payload, timeout=20)
-            ts = time.strftime("%Y-%m-%d %H:%M:%S")
+            resp = self.session.post(self.forward_url, json=request_body(payload), timeout=20)
             if resp.status_code < 300:
-                print(f"[{ts}]，[{subj}]，转发成功~")
+                LOG.info("，[%s]，转发成功~", subj, extra={"subject": subj, "stage": "deliver"})
             else:
-                print(f"[{ts}]，[{subj}]，转发失败~ 状态码 {resp.status_code}")
+                LOG.error("，[%s]，转发失败~ 状态码 %s", subj, resp.status_code, extra={"subject": subj, "stage": "deliver", "status": resp.status_code})
         except Exception as e:
-            ts = time.strftime("%Y-%m-%d %H:%M:%S")
-            print(f"[{ts}]，[{subj}]，转发异常~ {e}")
+            LOG.error("，[%s]，转发异常~ %s", subj, e, extra={"subject": subj, "stage": "deliver", "error": str(e)})
+
+    def _parse_library_changed(self, raw) -> Tuple[List[str], List[str]]:
+        """Return the added item IDs and the library (collection folder) IDs of a LibraryChanged frame."""
+        try:
+            msg = json_loads(raw)
+        except Exception:
+            return [], []
+        if not isinstance(msg, dict) or (msg.get("MessageType") or msg.get("message_type")) != "LibraryChanged":
+            return [], []
+        data = msg.get("Data") or msg.get("data") or {}
+        items_added = data.get("ItemsAdded") or data.get("items_added") or []
+        folders = data.get("CollectionFolders") or data.get("collection_folders") or []
+        return list(dict.fromkeys([_id for _id in items_added if _id])), folders
+
+    def compile_rules(self, cfg: Dict, target_filters_on: bool) -> Dict[str, Any]:
+        """Filters, policies and field projection built from a config, ready for _apply_rules."""
+        keyword_filter = KeywordFilter(cfg.get("filters"))
+        library_policies = self._normalize_policies(cfg.get("library_policies") or [])
+        mode_fields, all_fields = self._compile_field_projection(
+            keyword_filter.active or target_filters_on, library_policies
+        )
+        return {
+            "keyword_filter": keyword_filter,
+            "library_policies": library_policies,
+            "policy_matcher": PolicyMatcher(library_policies),
+            "mode_fields": mode_fields,
+            "all_fields": all_fields,
+        }
+
+    def _apply_rules(self, rules: Dict[str, Any]):
+        # Plain assignments with no await in between; items read them through _snapshot_rules.
+        self.rules = rules
+        self.keyword_filter = rules["keyword_filter"]
+        self.library_policies = rules["library_policies"]
+        self.policy_matcher = rules["policy_matcher"]
+        self._mode_fields: Dict[str, Tuple[str, ...]] = rules["mode_fields"]
+        self._all_fields: Tuple[str, ...] = rules["all_fields"]
+        self._warned_libs.clear()
+
+    def _compile_field_projection(self, filters_on: bool, library_policies: Dict[str, Dict]) -> Tuple[Dict[str, Tuple[str, ...]], Tuple[str, ...]]:
+        modes = {p.get("mode", "per_episode") for p in library_policies.values()}
+
+        def project(needed: frozenset) -> Tuple[str, ...]:
+            if filters_on:
+                needed = needed | FILTER_FIELDS
+            return tuple(f for f in ITEM_FIELDS if f in needed)
+
+        # A per_episode library can still hold a folder whose own policy is album_only.
+        album_anywhere = BASE_FIELDS | (ALBUM_FIELDS if "album_only" in modes else frozenset())
+        mode_fields = {
+            "per_episode": project(album_anywhere),
+            "season_summary": project(BASE_FIELDS),
+            "album_only": project(BASE_FIELDS | ALBUM_FIELDS),
+        }
+        return mode_fields, project(album_anywhere)
+
+    def _fields_for_frame(self, folders: List[str]) -> Optional[Tuple[str, ...]]:
+        """Fields to request for a frame, from the policies of its libraries; None if all of them are muted."""
+        if not folders:
+            return self._all_fields
+        needed: set = set()
+        for fid in folders:
+            lib = self._library_index.get(fid)
+            if not lib:
+                return self._all_fields
+            mode = (self._pick_policy(*lib) or {}).get("mode", "per_episode")
+            if mode == "mute":
+                continue
+            needed.update(self._mode_fields.get(mode, self._all_fields))
+        if not needed:
+            return None
+        return tuple(f for f in ITEM_FIELDS if f in needed)
+
+    async def _ensure_ingest_workers(self):
+        if self._frame_queue is None:
+            self._frame_queue = asyncio.Queue(maxsize=self.ingest_queue_size)
+            self._shard_queues = [asyncio.Queue(maxsize=self.ingest_queue_size) for _ in range(self.ingest_workers)]
+        if self._ingest_tasks and not any(t.done() for t in self._ingest_tasks):
+            return
+        for t in self._ingest_tasks:
+            t.cancel()
+        self._ingest_tasks = [asyncio.create_task(self._frame_dispatcher())]
+        self._ingest_tasks += [asyncio.create_task(self._item_worker(q)) for q in self._shard_queues]
+
+    async def _enqueue_frame(self, ids: List[str], fields: Tuple[str, ...] = ITEM_FIELDS):
+        """Hand a frame to the dispatcher; the overflow policy decides what happens when the queue is full."""
+        await self._ensure_ingest_workers()
+        q = self._frame_queue
+        if self.ingest_overflow == "drop_oldest" and q.full():
+            try:
+                dropped = q.get_nowait()[0]
+                q.task_done()
+                LOG.warning("【队列已满】丢弃最早的 %d 个条目", len(dropped), extra={"server": self.name, "stage": "frame_queue", "count": len(dropped)})
+            except asyncio.QueueEmpty:
+                pass
+            q.put_nowait((ids, fields, time.monotonic()))
+            return
+        await q.put((ids, fields, time.monotonic()))
+
+    def _shard_for(self, item: Dict) -> int:
+        """Items of one series always land on the same worker, so they are handled in arrival order."""
+        key = item.get("SeriesId") or item.get("ParentId") or item.get("Id") or ""
+        return hash(key) % len(self._shard_queues)
+
+    async def _next_batch(self) -> Tuple[List[str], Tuple[str, ...]]:
+        """Merge the frames that arrive within the coalescing window into one de-duplicated ID list."""
+        q = self._frame_queue
+        ids, fields, queued_at = await q.get()
+        self._m_frame_queue.observe(time.monotonic() - queued_at)
+        batch = dict.fromkeys(ids)
+        needed = set(fields)
+        q.task_done()
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.coalesce_window
+        while len(batch) < self.coalesce_max_ids:
+            try:
+                frame = q.get_nowait()
+            except asyncio.QueueEmpty:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    frame = await asyncio.wait_for(q.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+            q.task_done()
+            ids, fields, queued_at = frame
+            self._m_frame_queue.observe(time.monotonic() - queued_at)
+            batch.update(dict.fromkeys(ids))
+            needed.update(fields)
+        return list(batch), tuple(f for f in ITEM_FIELDS if f in needed)
+
+    async def _route_items(self, items: List[Dict]):
+        for it in items:
+            if not it.get("Id"):
+                continue
+            # Claimed here, not when processed: after a reconnect backfill pages and live frames overlap,
+            # and an item both of them route before either worker reaches it would be pushed twice.
+            if self._seen_items.check_and_add(str(it["Id"])):
+                continue
+            await self._shard_queues[self._shard_for(it)].put((it, time.monotonic()))
+
+    async def _frame_dispatcher(self):
+        while True:
+            ids, fields = await self._next_batch()
+            try:
+                async for items in self.iter_items_by_ids_async(ids, fields):
+                    await self._route_items(items)
+            except Exception as e:
+                LOG.error("【分发失败】错误 %s", e, extra={"server": self.name, "stage": "dispatch", "error": str(e)})
+
+    async def _item_worker(self, q: asyncio.Queue):
+        while True:
+            it, queued_at = await q.get()
+            self._m_item_queue.observe(time.monotonic() - queued_at)
+            self._m_items.inc()
+            try:
+                await self._process_item(it)
+            except Exception as e:
+                LOG.error("【处理失败】Item %s 错误 %s", it.get("Id"), e, extra={"server": self.name, "item": it.get("Id"), "stage": "process", "error": str(e)})
+            finally:
+                q.task_done()
+
+    def _mark_processed(self, it: Dict):
+        created = it.get("DateCreated") or ""
+        if created > self._high_water:
+            self._high_water = created
+            if self.state is not None:
+                self.state.put("meta", self._high_water_key, created)
+
+    async def backfill(self):
+        """Replay items created since the high-water mark through the normal pipeline, page by page."""
+        since = self._high_water
+        if not since:
+            return
+        await self._ensure_ingest_workers()
+        start = 0
+        total = 0
+        while True:
+            try:
+                page = await self._run_blocking(self._fetch_items_since, since, start)
+            except Exception as e:
+                LOG.error("【补漏失败】状态码 %s 错误 %s", self._status_code_of(e), e, extra={"server": self.name, "stage": "backfill", "status": self._status_code_of(e), "error": str(e)})
+                return
+            start += len(page)
+            # MinDateCreated is inclusive; items at the mark itself were already handled.
+            fresh = [it for it in page if (it.get("DateCreated") or "") > since and str(it.get("Id")) not in self._seen_items]
+            total += len(fresh)
+            if fresh and self.recorder is not None:
+                self.recorder.write("backfill", self.name, items=fresh)
+            await self._route_items(fresh)
+            if len(page) < self.backfill_page_size:
+                break
+        if total:
+            LOG.info("【补漏】断线期间新增 %d 个条目", total, extra={"server": self.name, "stage": "backfill", "count": total})
+
+    def _start_backfill(self):
+        if self._backfill_task is None or self._backfill_task.done():
+            self._backfill_task = asyncio.create_task(self.backfill())
+
+    async def _process_item(self, it: Dict):
+        self._mark_processed(it)
+        # Taken before the first await: a reload landing mid-way doesn't mix old and new rules.
+        rules = self._snapshot_rules()
+        started = time.monotonic()
+        lib_id, lib_name = await self.get_library_for_async(it)
+        lib = (lib_id, lib_name)
+        # Targets with their own library_policies entry for this library follow it instead of the server's.
+        routes: Dict[Tuple[str, str], Set[str]] = {}
+        for t, target_rules in rules.targets:
+            own = target_rules[2].match(lib_id, lib_name) if target_rules[2] is not None else None
+            if own:
+                own_mode = own.get("mode", "per_episode")
+                routes.setdefault((own_mode, own_mode), set()).add(t.name)
+        overridden = set().union(*routes.values())
+        if not overridden or len(overridden) < len(rules.targets):
+            policy = self._pick_policy(lib_id, lib_name, rules.bot) or {}
+            mode = policy.get("mode", "per_episode")
+            if not policy:
+                key = f"{lib_id or 'NA'}::{lib_name or 'NA'}"
+                if key not in self._warned_libs:
+                    LOG.warning("【提示】未为该库匹配到策略，按 per_episode 处理：Id=%s, Name=%s, Norm=%s", lib_id or "NA", lib_name or "NA", self._norm_name(lib_name), extra={"server": self.name, "item": it.get("Id")})
+                    self._warned_libs.add(key)
+            if mode != "mute":
+                pol_it = (await self._pick_policy_for_item_async(it, rules.bot)) or policy
+                rest = {t.name for t, _ in rules.targets} - overridden
+                routes.setdefault((mode, pol_it.get("mode", "per_episode")), set()).update(rest)
+        self._m_policy.observe(time.monotonic() - started)
+        for (mode, mode_it), allowed in routes.items():
+            await self._route_item(it, lib, mode, mode_it, rules, allowed)
+
+    async def _route_item(self, it: Dict, lib: Tuple[str, str], mode: str, mode_it: str, rules: "RuleSnapshot", allowed: Set[str]):
+        """Push or queue one item for the targets in `allowed`, by library mode and the item's own policy."""
+        if mode == "mute":
+            return
+        t = (it.get("Type") or "")
+        if mode == "season_summary":
+            if mode_it != "season_summary":
+                return
+            if t == "Episode":
+                await self._queue_episode_for_season(it, lib, rules, allowed)
+            elif t == "Movie":
+                targets = self._admit(lib, self._hay_from_item(it), rules, allowed)
+                if targets:
+                    await self._queue_movie(it, targets)
+            return
+        if mode == "album_only":
+            if mode_it != "album_only" or t != "MusicAlbum":
+                return
+            targets = self._admit(lib, self._hay_from_item(it), rules, allowed)
+            if not targets:
+                return
+            await self.prefetch_image(it)
+            payload = self.build_payload(it)
+            await self.forward_async(payload, None, targets)
+            return
+        if mode_it == "mute":
+            return
+        if mode_it == "album_only":
+            if t == "MusicAlbum":
+                targets = self._admit(lib, self._hay_from_item(it), rules, allowed)
+                if targets:
+                    await self.prefetch_image(it)
+                    payload = self.build_payload(it)
+                    await self.forward_async(payload, None, targets)
+            return
+        if mode_it == "season_summary":
+            if t == "Episode":
+                await self._queue_episode_for_season(it, lib, rules, allowed)
+                return
+            if t == "Movie":
+                targets = self._admit(lib, self._hay_from_item(it), rules, allowed)
+                if targets:
+                    await self._queue_movie(it, targets)
+                return
+        if t == "Episode":
+            targets = self._admit(lib, self._hay_from_item(it), rules, allowed)
+            if not targets:
+                return
+            ep_id = str(it.get("Id") or "")
+            if self._episode_suppressed(ep_id):
+                return
+            await self.prefetch_image(it)
+            payload = self.build_payload(it)
+            await self.forward_async(payload, it.get("SeriesId"), targets)
+        elif t == "Movie":
+            targets = self._admit(lib, self._hay_from_item(it), rules, allowed)
+            if not targets:
+                return
+            await self._queue_movie(it, targets)
+
+    async def _queue_episode_for_season(self, it: Dict, lib: Tuple[str, str], rules: "RuleSnapshot", allowed: Optional[Set[str]] = None):
+        sid = it.get("SeriesId") or ""
+        s_no = int(it.get("ParentIndexNumber") or 0)
+        s_name = it.get("SeriesName") or ""
+        targets = self._admit(lib, self._hay_for_series(s_name, it), rules, allowed)
+        if targets:
+            await self._queue_season_summary(sid, s_no, s_name, [it], targets)
 
     async def run_ws(self):
         ws_url = (self.server.replace("http", "ws").rstrip("/")) + "/socket"
-        params = f"?api_key={self.token}"
         backoff = 1
+        connected = False
+        await self.restore_state()
+        await self._ensure_ingest_workers()
         while True:
+            # Each server authenticates on its own; one that is down or rejects us only stalls itself.
+            if self.token is None:
+                try:
+                    await self._run_blocking(self.login)
+                except Exception as e:
+                    LOG.error("【登录失败】[重试等待 %ss] 状态码 %s 错误 %s", backoff, self._status_code_of(e), e, extra={"server": self.name, "stage": "login", "status": self._status_code_of(e), "error": str(e)})
+                    await asyncio.sleep(backoff)
+                    backoff = min(backoff * 2, 30)
+                    continue
+            if self.prewarm_enabled and self._index_task is None:
+                await self.refresh_library_index()
+                self._index_task = asyncio.create_task(self._library_index_refresher())
             try:
-                async with websockets.connect(ws_url + params, ping_interval=30) as ws:
+                async with websockets.connect(f"{ws_url}?api_key={self.token}", ping_interval=30) as ws:
                     backoff = 1
                     await ws.send(json.dumps({"MessageType": "KeepAlive"}))
+                    # Only LibraryChanged matters; make sure no periodic feeds are pushed on this connection.
+                    for stop in ("SessionsStop", "ScheduledTasksInfoStop", "ActivityLogEntryStop"):
+                        await ws.send(json.dumps({"MessageType": stop}))
+                    if self.backfill_enabled and (connected or self.backfill_on_startup):
+                        self._start_backfill()
+                    connected = True
                     async for raw in ws:
-                        try:
-                            msg = json.loads(raw)
-                        except Exception:
-                            continue
-                        if (msg.get("MessageType") or msg.get("message_type")) != "LibraryChanged":
+                        received = time.monotonic()
+                        if not frame_is_library_changed(raw):
+                            self._m_skipped.inc()
                             continue
-                        data = msg.get("Data") or msg.get("data") or {}
-                        items_added = data.get("ItemsAdded") or data.get("items_added") or []
-                        ids_added = list(dict.fromkeys([_id for _id in items_added if _id]))
+                        ids_added, folders = self._parse_library_changed(raw)
                         if not ids_added:
                             continue
-                        items = self.get_items_by_ids(ids_added)
-                        if not items:
-                            continue
-                        by_lib: Dict[str, Dict] = {}
-                        for it in items:
-                            item_id = it.get("Id")
-                            if not item_id:
-                                continue
-                            lib_id, lib_name = self.get_library_for(it)
-                            key = f"{lib_id or 'NA'}::{lib_name or 'NA'}"
-                            pack = by_lib.setdefault(key, {"lib_id": lib_id, "lib_name": lib_name, "items": []})
-                            pack["items"].append(it)
-                        for pack in by_lib.values():
-                            lib_id, lib_name, its = pack["lib_id"], pack["lib_name"], pack["items"]
-                            policy = self._pick_policy(lib_id, lib_name) or {}
-                            mode = policy.get("mode", "per_episode")
-                            if not policy:
-                                key = f"{lib_id or 'NA'}::{lib_name or 'NA'}"
-                                if key not in self._warned_libs:
-                                    print(f"[提示] 未为该库匹配到策略，按 per_episode 处理：Id={lib_id or 'NA'}, Name={lib_name or 'NA'}, Norm={self._norm_name(lib_name)}")
-                                    self._warned_libs.add(key)
-                            if mode == "mute":
-                                continue
-                            if mode == "season_summary":
-                                groups: Dict[Tuple[str, int, str], List[Dict]] = defaultdict(list)
-                                for it in its:
-                                    pol_it = self._pick_policy_for_item(it) or policy
-                                    mode_it = pol_it.get("mode", "per_episode")
-                                    if mode_it != "season_summary":
-                                        continue
-                                    if it.get("Type") == "Episode":
-                                        sid = it.get("SeriesId") or ""
-                                        s_no = int(it.get("ParentIndexNumber") or 0)
-                                        s_name = it.get("SeriesName") or ""
-                                        groups[(sid, s_no, s_name)].append(it)
-                                for (sid, s_no, s_name), eps in groups.items():
-                                    if not eps:
-                                        continue
-                                    if not self._pass_filters(self._hay_for_series(s_name, eps[0])):
-                                        continue
-                                    await self._queue_season_summary(sid, s_no, s_name, eps)
-                                for it in its:
-                                    pol_it = self._pick_policy_for_item(it) or policy
-                                    mode_it = pol_it.get("mode", "per_episode")
-                                    if mode_it != "season_summary":
-                                        continue
-                                    if (it.get("Type") or "") == "Movie":
-                                        if not self._pass_filters(self._hay_from_item(it)):
-                                            continue
-                                        await self._queue_movie(it)
-                            elif mode == "album_only":
-                                for it in its:
-                                    pol_it = self._pick_policy_for_item(it) or policy
-                                    mode_it = pol_it.get("mode", "per_episode")
-                                    if mode_it != "album_only":
-                                        continue
-                                    if (it.get("Type") or "") != "MusicAlbum":
-                                        continue
-                                    if not self._pass_filters(self._hay_from_item(it)):
-                                        continue
-                                    payload = self.build_payload(it)
-                                    await self.forward_async(payload)
-                            else:
-                                for it in its:
-                                    pol_it = self._pick_policy_for_item(it) or policy
-                                    mode_it = pol_it.get("mode", "per_episode")
-                                    t = (it.get("Type") or "")
-                                    if mode_it == "mute":
-                                        continue
-                                    if mode_it == "album_only":
-                                        if (t == "MusicAlbum") and self._pass_filters(self._hay_from_item(it)):
-                                            payload = self.build_payload(it)
-                                            await self.forward_async(payload)
-                                        continue
-                                    if mode_it == "season_summary":
-                                        if t == "Episode":
-                                            sid = it.get("SeriesId") or ""
-                                            s_no = int(it.get("ParentIndexNumber") or 0)
-                                            s_name = it.get("SeriesName") or ""
-                                            if self._pass_filters(self._hay_for_series(s_name, it)):
-                                                await self._queue_season_summary(sid, s_no, s_name, [it])
-                                            continue
-                                        if t == "Movie":
-                                            if self._pass_filters(self._hay_from_item(it)):
-                                                await self._queue_movie(it)
-                                            continue
-                                    if t == "Episode":
-                                        if not self._pass_filters(self._hay_from_item(it)):
-                                            continue
-                                        ep_id = str(it.get("Id") or "")
-                                        if self._episode_suppressed(ep_id):
-                                            continue
-                                        payload = self.build_payload(it)
-                                        await self.forward_async(payload)
-                                    elif t == "Movie":
-                                        if not self._pass_filters(self._hay_from_item(it)):
-                                            continue
-                                        await self._queue_movie(it)
-                                    else:
-                                        continue
+                        self._m_frames.inc()
+                        if self.recorder is not None:
+                            self.recorder.write("frame", self.name, raw=raw if isinstance(raw, str) else raw.decode("utf-8", "replace"))
+                        fields = self._fields_for_frame(folders)
+                        if fields is not None:
+                            await self._enqueue_frame(ids_added, fields)
+                        self._m_receive.observe(time.monotonic() - received)
             except Exception as e:
-                ts = time.strftime("%Y-%m-%d %H:%M:%S")
-                print(f"[{ts}]，[重连等待 {backoff}s]，原因：{e}")
+                LOG.warning("，[重连等待 %ss]，原因：%s", backoff, e, extra={"server": self.name, "stage": "websocket", "error": str(e)})
+                # The handshake was refused: the token expired or was revoked, log in again.
+                if getattr(getattr(e, "response", None), "status_code", None) in (401, 403) or getattr(e, "status_code", None) in (401, 403):
+                    self.token = None
                 await asyncio.sleep(backoff)
                 backoff = min(backoff * 2, 30)
 
+class _VirtualSelector:
+    """Wraps the loop's selector: instead of sleeping until the next timer, jump the clock to it."""
+
+    def __init__(self, selector, loop: "VirtualTimeLoop"):
+        self._selector = selector
+        self._loop = loop
+
+    def select(self, timeout: Optional[float] = None):
+        events = self._selector.select(0)
+        if events or (timeout is not None and timeout <= 0):
+            return events
+        if timeout is None:
+            return self._selector.select(None)
+        self._loop.skew += timeout
+        return []
+
+    def __getattr__(self, name: str):
+        return getattr(self._selector, name)
+
+class VirtualTimeLoop(asyncio.SelectorEventLoop):
+    """Event loop whose clock skips idle time, so delay windows cost nothing during replay."""
+
+    def __init__(self):
+        super().__init__()
+        self.skew = 0.0
+        self._selector = _VirtualSelector(self._selector, self)
+
+    def time(self) -> float:
+        return super().time() + self.skew
+
+class ReplaySink:
+    """Stands in for the delivery queues: counts payloads and optionally writes them as JSON lines."""
+
+    def __init__(self, out: Optional[TextIO] = None):
+        self.out = out
+        self.count = 0
+
+    def sender(self, target: str) -> Callable[..., bool]:
+        def submit(payload: Dict, order_key: Optional[str] = None) -> bool:
+            self.count += 1
+            if self.out is not None:
+                self.out.write(json.dumps({"t": round(CLOCK.time(), 3), "target": target, "payload": payload}, ensure_ascii=False) + "\n")
+            return True
+        return submit
+
+class ReplayServer(RealtimeItemAdded):
+    """A server whose Jellyfin is a recorded log; lookups are answered from memory, inline."""
+
+    def __init__(self, cfg: Dict, hub: NotifyHub, items: Dict[str, Dict], ancestors: Dict[str, List[Dict]], index: Dict[str, Tuple[str, str]]):
+        super().__init__(cfg, hub)
+        self._recorded_items = items
+        self._recorded_ancestors = ancestors
+        self._library_index = dict(index)
+        self.prewarm_enabled = False
+        self.backfill_enabled = False
+        self.token = "replay"
+
+    def login(self):
+        pass
+
+    async def _run_blocking(self, fn, *args):
+        return fn(*args)
+
+    def _fetch_items(self, ids: List[str], fields: Tuple[str, ...] = ITEM_FIELDS) -> List[Dict]:
+        return [dict(self._recorded_items[i]) for i in ids if i in self._recorded_items]
+
+    def _fetch_ancestors(self, item_key: str) -> Optional[List[Dict]]:
+        return self._recorded_ancestors.get(item_key)
+
+    def load_library_index(self) -> Dict[str, Tuple[str, str]]:
+        return dict(self._library_index)
+
+async def replay(log_path: str, cfg: Dict, out: Optional[TextIO] = None) -> Dict[str, Any]:
+    """Stream a recorded log through policy, filters, batching and payload building.
+
+    Must run on a VirtualTimeLoop: the gaps between recorded frames and every delay window
+    elapse instantly, while their order and relative timing are preserved.
+    """
+    global CLOCK
+    items: Dict[str, Dict[str, Dict]] = {}
+    ancestors: Dict[str, Dict[str, List[Dict]]] = {}
+    index: Dict[str, Dict[str, Tuple[str, str]]] = {}
+    start: Optional[float] = None
+    # Items are fetched after their frame, so gather all metadata before streaming the frames.
+    for rec in TrafficRecorder.read(log_path):
+        server = rec.get("s") or ""
+        kind = rec.get("k")
+        if start is None:
+            start = rec.get("t")
+        if kind in ("items", "backfill"):
+            bucket = items.setdefault(server, {})
+            for it in rec.get("items") or []:
+                if it.get("Id"):
+                    bucket[it["Id"]] = it
+        elif kind == "ancestors":
+            ancestors.setdefault(server, {})[rec["key"]] = rec.get("ancestors") or []
+        elif kind == "index":
+            index[server] = {k: tuple(v) for k, v in (rec.get("index") or {}).items()}
+        items.setdefault(server, {})
+
+    loop = asyncio.get_running_loop()
+    saved_clock, CLOCK = CLOCK, VirtualClock(loop, start or time.time())
+    try:
+        replay_cfg = {
+            **cfg,
+            "forward_url": cfg.get("forward_url") or "replay://sink",
+            "state": {"path": ""},
+            "record": {"enabled": False},
+            "reload": {"enabled": False},
+            "metrics": {"enabled": False},
+            "images": {"enabled": False},
+        }
+        hub = NotifyHub(replay_cfg)
+        sink = ReplaySink(out)
+        for t in hub.targets:
+            t.digest.send = sink.sender(t.name)
+        configured = {c["name"]: c for c in server_configs(replay_cfg)}
+        bots: Dict[str, ReplayServer] = {}
+        for name in items:
+            server_cfg = configured.get(name) or {**replay_cfg, "name": name}
+            bots[name] = ReplayServer(server_cfg, hub, items[name], ancestors.get(name, {}), index.get(name, {}))
+            await bots[name]._ensure_ingest_workers()
+
+        frames = 0
+        for rec in TrafficRecorder.read(log_path):
+            kind = rec.get("k")
+            if kind not in ("frame", "backfill"):
+                continue
+            delay = rec.get("t", 0) - CLOCK.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            bot = bots[rec.get("s") or ""]
+            if kind == "backfill":
+                await bot._route_items([dict(it) for it in rec.get("items") or []])
+                continue
+            ids_added, folders = bot._parse_library_changed(rec.get("raw") or "")
+            if not ids_added:
+                continue
+            frames += 1
+            fields = bot._fields_for_frame(folders)
+            if fields is not None:
+                await bot._enqueue_frame(ids_added, fields)
+
+        # Nothing here waits on real I/O, so a virtual sleep returns only once all work is done.
+        coalesce = max((b.coalesce_window for b in bots.values()), default=0)
+        idle = max(hub.season_summary_delay, hub.movie_delay_seconds) + coalesce + 1
+        while True:
+            await asyncio.sleep(idle)
+            pending = hub._season_batches or hub._movie_queue or any(t.digest._timer is not None for t in hub.targets)
+            if not pending:
+                break
+        tasks = [t for b in bots.values() for t in b._ingest_tasks]
+        if hub._season_flush_task is not None:
+            tasks.append(hub._season_flush_task)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        return {
+            "frames": frames,
+            "items": sum(len(v) for v in items.values()),
+            "notifications": sink.count,
+            "virtual_seconds": round(CLOCK.time() - (start or CLOCK.time()), 1),
+        }
+    finally:
+        CLOCK = saved_clock
+
+def run_replay(log_path: str, sink_path: Optional[str]):
+    cfg = load_config()
+    out = None
+    if sink_path == "-":
+        out = sys.stdout
+    elif sink_path:
+        out = open(sink_path, "w", encoding="utf-8")
+    # Keep stdout clean for the sink.
+    listener = setup_logging(cfg, sys.stderr if out is sys.stdout else None)
+    loop = VirtualTimeLoop()
+    started = time.perf_counter()
+    try:
+        summary = loop.run_until_complete(replay(log_path, cfg, out))
+        LOG.info(
+            "【回放完成】帧 %d 条目 %d 推送 %d 虚拟时长 %ss 实际耗时 %.2fs",
+            summary["frames"], summary["items"], summary["notifications"], summary["virtual_seconds"], time.perf_counter() - started,
+            extra={"stage": "replay", "count": summary["notifications"]},
+        )
+    finally:
+        loop.close()
+        if out is not None and out is not sys.stdout:
+            out.close()
+        listener.stop()
+
 def main():
-    bot = RealtimeItemAdded()
-    bot.login()
-    asyncio.run(bot.run_ws())
+    global CONFIG_FILE
+    parser = argparse.ArgumentParser(description="Jellyfin 新增条目推送")
+    parser.add_argument("--config", default=CONFIG_FILE, help="配置文件路径")
+    parser.add_argument("--replay", metavar="LOG", help="回放录制的日志（record.path），不连接Jellyfin也不真正推送")
+    parser.add_argument("--sink", metavar="FILE", help="回放时把生成的推送逐行写入该文件，- 为标准输出")
+    args = parser.parse_args()
+    CONFIG_FILE = args.config
+    if args.replay:
+        run_replay(args.replay, args.sink)
+        return
+    cfg = load_config()
+    listener = setup_logging(cfg)
+    try:
+        hub = NotifyHub(cfg)
+        bots = [RealtimeItemAdded(c, hub) for c in server_configs(cfg)]
+        asyncio.run(hub.run(bots))
+    finally:
+        listener.stop()
 
 if __name__ == "__main__":
     main()
\ No newline at end of file